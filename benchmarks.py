@@ -0,0 +1,298 @@
+"""
+Benchmarks of each stage of the pipeline on synthetic inputs.
+
+Frames are smoothly drifting random PNG images and the flute bank is 6 x 10 synthetic WAV tones,
+generated in a work folder, so that timings are comparable between machines and commits. Every
+stage is timed on its own, next to the per-pair or per-combination code paths it replaced, and
+the results are written as json.
+
+    python benchmarks.py --frames 200 --width 640 --height 360 --output benchmark.json
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import itertools
+import contextlib
+import subprocess
+from argparse import ArgumentParser
+
+import numpy as np
+
+DEFAULTFRAMES = 100
+DEFAULTWIDTH = 320
+DEFAULTHEIGHT = 180
+DEFAULTFPS = 25
+DEFAULTPERPAIRFRAMES = 20
+DEFAULTEMBEDDINGS = 2000
+DEFAULTEMBEDDINGDIM = 2048
+DEFAULTNBFINALIMAGES = 10
+DEFAULTNBFLUTES = 6
+DEFAULTNBSAMPLES = 10
+DEFAULTCOMBINATIONS = 2000
+DEFAULTREFERENCECOMBINATIONS = 20
+DEFAULTNBFINALCOMBS = 10
+DEFAULTNBSTEPS = 200
+DEFAULTWORKERS = 4
+DEFAULTREPEAT = 1
+DEFAULTSEED = 1334
+
+STAGES = ['extraction', 'pairwise', 'distances', 'pairsfind', 'features', 'search']
+
+
+def timeStage(results, name, function, items=None, repeat=DEFAULTREPEAT, **info):
+    """
+    Best of repeat runs of function, with its prints silenced, recorded in results under name.
+    Returns the value of the last run.
+    """
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            value = function()
+        runs.append(time.perf_counter() - start)
+    best = min(runs)
+    results[name] = {
+        'seconds': best,
+        'runs': runs,
+        'items': items,
+        'items_per_second': items / best if items and best > 0 else None,
+        **info,
+    }
+    rate = f"{items / best:>14.1f} /s" if items and best > 0 else ""
+    print(f"{name:<45}{best:>12.4f} s{rate}")
+    return value
+
+def makeFrames(folder, nb_frames, width, height, seed=DEFAULTSEED):
+    """
+    PNG frames %06d.png of a random walk of low resolution color noise, upsampled.
+    """
+    import cv2
+
+    os.makedirs(folder, exist_ok=True)
+    rng = np.random.RandomState(seed)
+    low = rng.rand(9, 16, 3) * 255
+    for n in range(nb_frames):
+        low = np.clip(low + rng.randn(*low.shape) * 12, 0, 255)
+        frame = cv2.resize(low.astype(np.float32), (width, height), interpolation=cv2.INTER_CUBIC)
+        cv2.imwrite(os.path.join(folder, f"{n + 1:06d}.png"), np.clip(frame, 0, 255).astype(np.uint8))
+    return sorted(os.path.join(folder, name) for name in os.listdir(folder))
+
+def makeVideo(frames_folder, video_path, fps=DEFAULTFPS):
+    command = [
+        'ffmpeg', '-nostdin', '-v', 'error', '-y',
+        '-framerate', str(fps),
+        '-i', os.path.join(frames_folder, '%06d.png'),
+        '-pix_fmt', 'yuv420p',
+        video_path
+    ]
+    subprocess.run(command, check=True)
+
+def makeFluteBank(folder, nb_flutes=DEFAULTNBFLUTES, nb_samples=DEFAULTNBSAMPLES, seconds=2, seed=DEFAULTSEED):
+    """
+    WAV tones named flute_<flute><sample>.wav, the flute digit at [-6] as soundMfccMaxDistances
+    expects: one pitch per flute, breath noise and vibrato growing with the sample index.
+    Returns the paths by flute label.
+    """
+    import soundfile as sf
+    from soundMfccMaxDistances import SAMPLINGRATE
+
+    os.makedirs(folder, exist_ok=True)
+    rng = np.random.RandomState(seed)
+    t = np.arange(seconds * SAMPLINGRATE) / SAMPLINGRATE
+    flutes = {}
+    for k in range(nb_flutes):
+        f0 = 261.63 * 2 ** (2 * k / 12)
+        flutes[f"flute {k}"] = []
+        for n in range(nb_samples):
+            vibrato = 1 + 0.01 * n / nb_samples * np.sin(2 * np.pi * 5 * t)
+            y = sum(np.sin(2 * np.pi * h * f0 * vibrato * t) / h ** 2 for h in range(1, 6))
+            y = y + 0.05 * (1 + n) * rng.randn(len(t))
+            path = os.path.join(folder, f"flute_{k}{n}.wav")
+            sf.write(path, (0.3 * y / np.abs(y).max()).astype(np.float32), SAMPLINGRATE)
+            flutes[f"flute {k}"].append(path)
+    return flutes
+
+def syntheticEmbeddings(nb_items, dim, seed=DEFAULTSEED):
+    """
+    Clustered non-negative float32 embeddings, like pooled ResNet features.
+    """
+    rng = np.random.RandomState(seed)
+    centers = rng.rand(max(1, nb_items // 50), dim).astype(np.float32)
+    embeddings = centers[rng.randint(len(centers), size=nb_items)] + 0.1 * rng.rand(nb_items, dim).astype(np.float32)
+    return np.ascontiguousarray(embeddings)
+
+def benchmarkExtraction(results, args, frames_folder):
+    import extracVideoFrames as extraction
+
+    if shutil.which('ffmpeg') is None or shutil.which('ffprobe') is None:
+        results['extraction'] = {'skipped': 'ffmpeg or ffprobe not found'}
+        print(f"{'extraction':<45}{'skipped, ffmpeg or ffprobe not found':>30}")
+        return
+    video = os.path.join(args.workdir, 'video.mp4')
+    makeVideo(frames_folder, video)
+
+    def extractInto(name, extract):
+        folder = os.path.join(args.workdir, name)
+        shutil.rmtree(folder, ignore_errors=True)
+        os.makedirs(folder)
+        extract(folder)
+
+    timeStage(results, 'extraction serial', lambda: extractInto(
+        'serial', lambda folder: extraction.extract_all_frames(video, folder)), args.frames, args.repeat)
+    timeStage(results, f"extraction {args.workers} segments", lambda: extractInto(
+        'segments', lambda folder: extraction.extract_all_frames_parallel(video, folder, args.workers)),
+        args.frames, args.repeat)
+    timeStage(results, 'extraction stream', lambda: extraction.stream_all_frames(video), args.frames, args.repeat)
+
+def benchmarkPairwise(results, args, frames):
+    import naiveImageSimilarity as naive
+
+    nb_pairs = args.frames * (args.frames - 1) // 2
+    imgs, hists = timeStage(results, 'pairwise decode', lambda: naive.load_frames(frames), args.frames, args.repeat)
+    timeStage(results, 'pairwise l0 matrix', lambda: naive.pairwise_l0(imgs), nb_pairs, args.repeat)
+    timeStage(results, 'pairwise emd matrix', lambda: naive.pairwise_earth_movers_distances(hists), nb_pairs, args.repeat)
+
+    # per-pair functions, decoding both images of every pair, on a subset
+    subset = frames[:args.per_pair_frames]
+    pairs = list(itertools.combinations(subset, 2))
+    timeStage(results, 'pairwise l0 per pair', lambda: [naive.l0(a, b) for a, b in pairs], len(pairs), args.repeat)
+    timeStage(results, 'pairwise emd per pair', lambda: [naive.earth_movers_distance(a, b) for a, b in pairs],
+              len(pairs), args.repeat)
+
+def benchmarkDistances(results, args, embeddings):
+    from scipy.spatial import distance_matrix
+    from imageEmbeddingsMaxDistances import blockedDistanceMatrix
+
+    nb_pairs = len(embeddings) * (len(embeddings) - 1) // 2
+    npfile = os.path.join(args.workdir, 'distances.npy')
+    timeStage(results, 'distance matrix blocked', lambda: blockedDistanceMatrix(embeddings, npfile),
+              nb_pairs, args.repeat, shape=list(embeddings.shape))
+    timeStage(results, 'distance matrix scipy', lambda: distance_matrix(embeddings, embeddings),
+              nb_pairs, args.repeat, shape=list(embeddings.shape))
+
+def benchmarkPairsFind(results, args, embeddings):
+    from imageEmbeddingsMaxDistances import pairsFind
+    from maxMinSearch import minDistance
+
+    for init in ['random', 'greedy']:
+        def run():
+            np.random.seed(args.seed)
+            return pairsFind(None, embeddings, args.finalnbimages, args.nbsteps, init=init)
+        indexes = timeStage(results, f"pairsFind {init} init", run, args.nbsteps, args.repeat)
+        results[f"pairsFind {init} init"]['min_distance'] = float(minDistance(embeddings[indexes]))
+
+def loadSoundModule(flutes):
+    """
+    soundMfccMaxDistances with the globals its main sets up: sample bank, STFTs and bases.
+    """
+    import soundMfccMaxDistances as sound
+
+    sound.flutes = flutes
+    sound.bank = sound.loadSampleBank(flutes)
+    sound.mel_basis, sound.dct_basis = sound.getFeatureBases()
+    sound.stfts = sound.computeSampleStfts(sound.bank, sound.mel_basis.shape[1])
+    sound.space = sound.CombinationSpace([len(flutes[f]) for f in flutes])
+    return sound
+
+def benchmarkFeatures(results, args, flutes):
+    with contextlib.redirect_stdout(io.StringIO()):
+        import soundMfccMaxDistances as sound
+    timeStage(results, 'features sample bank', lambda: sound.loadSampleBank(flutes),
+              sum(len(paths) for paths in flutes.values()), args.repeat)
+    sound = timeStage(results, 'features setup (bank, STFTs)', lambda: loadSoundModule(flutes))
+
+    rng = np.random.RandomState(args.seed)
+    combs = sound.space.decode(rng.choice(len(sound.space), size=args.combinations, replace=False))
+    timeStage(results, 'features STFT engine', lambda: sound.computeFeaturesFromStfts(
+        combs, sound.stfts, sound.mel_basis, sound.dct_basis), len(combs), args.repeat)
+    reference = combs[:args.reference_combinations]
+    timeStage(results, 'features librosa per combination',
+              lambda: [sound.getMeanDescriptors(c) for c in reference], len(reference), args.repeat)
+    return sound
+
+def benchmarkSearch(results, args, sound):
+    from maxMinSearch import swapSearch
+
+    def run(candidates_per_step):
+        np.random.seed(args.seed)
+        indexes = np.random.choice(len(sound.space), size=args.nbcombs, replace=False)
+        return swapSearch(sound.getMeanMfccs, len(sound.space), indexes, args.nbsteps,
+                          candidates_per_step=candidates_per_step)
+
+    for candidates_per_step in [1, 8]:
+        name = f"search {candidates_per_step} candidates per step"
+        _, min_distance = timeStage(results, name, lambda: run(candidates_per_step), args.nbsteps, args.repeat)
+        results[name]['min_distance'] = float(min_distance)
+
+def machineInfo():
+    return {
+        'platform': platform.platform(),
+        'python': sys.version.split()[0],
+        'numpy': np.__version__,
+        'cpu_count': os.cpu_count(),
+    }
+
+if __name__ == "__main__":
+
+    ap = ArgumentParser()
+    ap.add_argument('--workdir', type=str, default=None)
+    ap.add_argument('--output', type=str, default='benchmark.json')
+    ap.add_argument('--stages', type=str, nargs='+', choices=STAGES, default=STAGES)
+    ap.add_argument('--frames', type=int, default=DEFAULTFRAMES)
+    ap.add_argument('--width', type=int, default=DEFAULTWIDTH)
+    ap.add_argument('--height', type=int, default=DEFAULTHEIGHT)
+    ap.add_argument('--per-pair-frames', type=int, default=DEFAULTPERPAIRFRAMES)
+    ap.add_argument('--embeddings', type=int, default=DEFAULTEMBEDDINGS)
+    ap.add_argument('--embedding-dim', type=int, default=DEFAULTEMBEDDINGDIM)
+    ap.add_argument('--finalnbimages', type=int, default=DEFAULTNBFINALIMAGES)
+    ap.add_argument('--combinations', type=int, default=DEFAULTCOMBINATIONS)
+    ap.add_argument('--reference-combinations', type=int, default=DEFAULTREFERENCECOMBINATIONS)
+    ap.add_argument('--nbcombs', type=int, default=DEFAULTNBFINALCOMBS)
+    ap.add_argument('--nbsteps', type=int, default=DEFAULTNBSTEPS)
+    ap.add_argument('--workers', type=int, default=DEFAULTWORKERS)
+    ap.add_argument('--repeat', type=int, default=DEFAULTREPEAT)
+    ap.add_argument('--seed', type=int, default=DEFAULTSEED)
+
+    args = ap.parse_args()
+    keep_workdir = args.workdir is not None
+    args.workdir = args.workdir or tempfile.mkdtemp(prefix='artex_benchmark_')
+    os.makedirs(args.workdir, exist_ok=True)
+
+    parameters = vars(args)
+    print(f"PARAMETERS:\n{json.dumps(parameters, sort_keys=True, indent=4)}")
+
+    results = {}
+    try:
+        if {'extraction', 'pairwise'} & set(args.stages):
+            frames_folder = os.path.join(args.workdir, 'frames')
+            frames = makeFrames(frames_folder, args.frames, args.width, args.height, args.seed)
+        if 'extraction' in args.stages:
+            benchmarkExtraction(results, args, frames_folder)
+        if 'pairwise' in args.stages:
+            benchmarkPairwise(results, args, frames)
+
+        if {'distances', 'pairsfind'} & set(args.stages):
+            embeddings = syntheticEmbeddings(args.embeddings, args.embedding_dim, args.seed)
+        if 'distances' in args.stages:
+            benchmarkDistances(results, args, embeddings)
+        if 'pairsfind' in args.stages:
+            benchmarkPairsFind(results, args, embeddings)
+
+        if {'features', 'search'} & set(args.stages):
+            flutes = makeFluteBank(os.path.join(args.workdir, 'flutes'), seed=args.seed)
+            sound = benchmarkFeatures(results, args, flutes) if 'features' in args.stages else loadSoundModule(flutes)
+        if 'search' in args.stages:
+            benchmarkSearch(results, args, sound)
+    finally:
+        if not keep_workdir:
+            shutil.rmtree(args.workdir, ignore_errors=True)
+
+    with open(args.output, 'w') as f:
+        json.dump({'machine': machineInfo(), 'parameters': parameters, 'stages': results}, f, indent=4)
+    print(f"Benchmark results saved at {args.output}")
@@ -0,0 +1,204 @@
+"""
+Inverted file (IVF) index over the rows of an embedding store, numpy only.
+
+Rows are partitioned by k-means into lists, each with its centroid and radius (the largest
+distance from the centroid to one of its rows). k-NN queries scan the rows of the nprobe lists
+nearest to the query, radius queries skip every list that the triangle inequality rules out and
+are exact. The index only keeps list assignments and radii, the embeddings stay in embeddings.npy,
+and is saved next to them as index.npz. Rows are only read block by block, when they are added.
+"""
+
+import os
+
+import numpy as np
+
+DEFAULTNPROBE = 8
+DEFAULTITERATIONS = 10
+DEFAULTBLOCKSIZE = 4096
+SAMPLESPERLIST = 64
+RETRAINGROWTH = 4
+
+
+def squaredDistances(a, b, b_norms=None):
+    b_norms = np.einsum('ij,ij->i', b, b) if b_norms is None else b_norms
+    d = np.einsum('ij,ij->i', a, a)[:, None] + b_norms[None, :] - 2 * (a @ b.T)
+    return np.maximum(d, 0, out=d)
+
+def nearestCentroids(embeddings, centroids, block_size=DEFAULTBLOCKSIZE):
+    """
+    Nearest centroid of each row and the distance to it, block by block.
+    """
+    centroid_norms = np.einsum('ij,ij->i', centroids, centroids)
+    assignments = np.empty(len(embeddings), dtype=np.int32)
+    distances = np.empty(len(embeddings), dtype=np.float32)
+    for i in range(0, len(embeddings), block_size):
+        d = squaredDistances(np.asarray(embeddings[i:i + block_size], dtype=np.float32), centroids, centroid_norms)
+        assignments[i:i + len(d)] = d.argmin(axis=1)
+        distances[i:i + len(d)] = np.sqrt(d[np.arange(len(d)), assignments[i:i + len(d)]])
+    return assignments, distances
+
+def growRadii(radii, embeddings, centroids, assignments, begin=0, block_size=DEFAULTBLOCKSIZE):
+    """
+    Grow radii in place to the distances from rows begin to len(assignments) - 1 of embeddings
+    to their centroids, block by block.
+    """
+    for i in range(begin, len(assignments), block_size):
+        rows = np.asarray(embeddings[i:i + block_size], dtype=np.float32)
+        block_assignments = assignments[i:i + len(rows)]
+        differences = rows - centroids[block_assignments]
+        np.maximum.at(radii, block_assignments, np.sqrt(np.einsum('ij,ij->i', differences, differences)))
+    return radii
+
+def kMeans(samples, nb_lists, iterations=DEFAULTITERATIONS, seed=0):
+    """
+    Lloyd iterations from random rows, empty lists restart from a random row.
+    """
+    rng = np.random.RandomState(seed)
+    centroids = samples[rng.choice(len(samples), size=nb_lists, replace=False)].copy()
+    for _ in range(iterations):
+        assignments, _ = nearestCentroids(samples, centroids)
+        counts = np.bincount(assignments, minlength=nb_lists)
+        sums = np.zeros_like(centroids, dtype=np.float64)
+        np.add.at(sums, assignments, samples)
+        empty = counts == 0
+        centroids[~empty] = (sums[~empty] / counts[~empty, None]).astype(np.float32)
+        centroids[empty] = samples[rng.choice(len(samples), size=int(empty.sum()))]
+    return centroids
+
+
+class EmbeddingIndex:
+    """
+    IVF index over the first len(assignments) rows of embeddings. radii are computed from the
+    rows if not given.
+    """
+
+    def __init__(self, embeddings, centroids, assignments, nb_trained, radii=None):
+        self.embeddings = embeddings
+        self.centroids = np.asarray(centroids, dtype=np.float32)
+        self.assignments = np.asarray(assignments, dtype=np.int32)
+        self.nb_trained = int(nb_trained)
+        if radii is None:
+            radii = growRadii(np.zeros(len(self.centroids), dtype=np.float32), embeddings, self.centroids, self.assignments)
+        self.radii = np.asarray(radii, dtype=np.float32)
+        self.refresh()
+
+    def __len__(self):
+        return len(self.assignments)
+
+    def refresh(self):
+        """
+        Lists from the assignments.
+        """
+        nb_lists = len(self.centroids)
+        self.order = np.argsort(self.assignments, kind='stable')
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(self.assignments, minlength=nb_lists))])
+
+    def rows(self, lists):
+        return np.concatenate([self.order[self.offsets[l]:self.offsets[l + 1]] for l in lists] or [np.zeros(0, dtype=int)])
+
+    def update(self, embeddings):
+        """
+        Index the rows added at the end of embeddings since the last update. The lists are
+        retrained once the index has grown RETRAINGROWTH times larger than its training set.
+        Returns whether anything changed.
+        """
+        self.embeddings = embeddings
+        if len(embeddings) == len(self):
+            return False
+        if len(embeddings) > RETRAINGROWTH * self.nb_trained:
+            rebuilt = buildIndex(embeddings)
+            self.centroids, self.assignments, self.nb_trained = rebuilt.centroids, rebuilt.assignments, rebuilt.nb_trained
+            self.radii = rebuilt.radii
+        else:
+            begin = len(self)
+            new_assignments, _ = nearestCentroids(embeddings[begin:], self.centroids)
+            self.assignments = np.concatenate([self.assignments, new_assignments])
+            growRadii(self.radii, embeddings, self.centroids, self.assignments, begin)
+        self.refresh()
+        return True
+
+    def knn(self, queries, k, nprobe=DEFAULTNPROBE, allowed=None):
+        """
+        Approximate k nearest rows of each query among the rows of its nprobe nearest lists,
+        restricted to the rows where the boolean array allowed is true.
+        Returns (Q, k) distances and rows, padded with inf and -1.
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+        rows = np.full((len(queries), k), -1, dtype=np.int64)
+        probes = np.argsort(squaredDistances(queries, self.centroids), axis=1)[:, :nprobe]
+        for q, query in enumerate(queries):
+            candidates = np.sort(self.rows(probes[q]))
+            if allowed is not None:
+                candidates = candidates[allowed[candidates]]
+            d = np.sqrt(squaredDistances(query[None], np.asarray(self.embeddings[candidates], dtype=np.float32))[0])
+            best = np.argsort(d, kind='stable')[:k]
+            distances[q, :len(best)] = d[best]
+            rows[q, :len(best)] = candidates[best]
+        return distances, rows
+
+    def radius(self, query, r, allowed=None):
+        """
+        All rows within distance r of query, exactly: a list is scanned only if its centroid is
+        closer than r plus its radius.
+        Returns the rows and their distances, by increasing distance.
+        """
+        query = np.asarray(query, dtype=np.float32)
+        to_centroids = np.sqrt(squaredDistances(query[None], self.centroids)[0])
+        candidates = np.sort(self.rows(np.flatnonzero(to_centroids <= r + self.radii)))
+        if allowed is not None:
+            candidates = candidates[allowed[candidates]]
+        d = np.sqrt(squaredDistances(query[None], np.asarray(self.embeddings[candidates], dtype=np.float32))[0])
+        within = np.flatnonzero(d <= r)
+        within = within[np.argsort(d[within], kind='stable')]
+        return candidates[within], d[within]
+
+    def save(self, folder, name='index'):
+        indexfile = os.path.join(folder, f"{name}.npz")
+        with open(f"{indexfile}.tmp", 'wb') as f:
+            np.savez(f, centroids=self.centroids, assignments=self.assignments, nb_trained=self.nb_trained,
+                     radii=self.radii)
+        os.replace(f"{indexfile}.tmp", indexfile)
+
+
+def buildIndex(embeddings, nb_lists=None, iterations=DEFAULTITERATIONS, seed=0):
+    """
+    k-means lists, about sqrt(N) of them, trained on at most SAMPLESPERLIST rows per list.
+    """
+    nb_items = len(embeddings)
+    nb_lists = nb_lists or max(1, int(np.sqrt(nb_items)))
+    nb_lists = min(nb_lists, nb_items)
+    rng = np.random.RandomState(seed)
+    sample = np.sort(rng.choice(nb_items, size=min(nb_items, SAMPLESPERLIST * nb_lists), replace=False))
+    centroids = kMeans(np.asarray(embeddings[sample], dtype=np.float32), nb_lists, iterations, seed)
+    assignments, _ = nearestCentroids(embeddings, centroids)
+    return EmbeddingIndex(embeddings, centroids, assignments, nb_items)
+
+def loadIndex(folder, embeddings, name='index'):
+    """
+    Index saved in folder, or None if missing or not built on these embeddings.
+    """
+    indexfile = os.path.join(folder, f"{name}.npz")
+    if not os.path.exists(indexfile):
+        return None
+    saved = np.load(indexfile)
+    if saved['centroids'].shape[1] != embeddings.shape[1] or len(saved['assignments']) > len(embeddings):
+        print(f"Index at {indexfile} does not match the embeddings, ignoring it")
+        return None
+    # indexes saved without radii get them from one pass over their rows
+    radii = saved['radii'] if 'radii' in saved else None
+    return EmbeddingIndex(embeddings, saved['centroids'], saved['assignments'], saved['nb_trained'], radii)
+
+def updateIndex(folder, embeddings, name='index'):
+    """
+    Index of the embeddings of a store, loaded and extended to the new rows, or built.
+    """
+    index = loadIndex(folder, embeddings, name)
+    if index is None:
+        index = buildIndex(embeddings)
+        print(f"Built index of {len(index)} embeddings in {len(index.centroids)} lists")
+        index.save(folder, name)
+    elif index.update(embeddings):
+        print(f"Updated index to {len(index)} embeddings in {len(index.centroids)} lists")
+        index.save(folder, name)
+    return index
@@ -0,0 +1,185 @@
+"""
+Embedding cache for imageEmbeddingsMaxDistances.py.
+
+Embeddings are stored per model under <resultsfolder>/embeddings/<repository>_<model>/ and keyed by
+frame file, so a re-run only embeds frames that are new or changed since the last one.
+
+embeddings.npy holds the contiguous float32 (N, D) embeddings and frames.json its header: model,
+dimension, number of frames and the key of each row. float16 and PCA-reduced copies of the store
+are derived from it as embeddings_<format>.npy, all loaded memory-mapped.
+"""
+
+import os
+import json
+import hashlib
+
+import numpy as np
+
+EMBEDDINGFORMATS = ['float32', 'float16', 'pca']
+DEFAULTPCADIM = 128
+PCASAMPLE = 20000
+DISTORTIONSAMPLE = 1000
+BLOCKSIZE = 4096
+
+
+def storeFolder(resultsfolder, repository, model):
+    name = f"{repository}_{model}".replace('/', '_').replace(':', '_')
+    return os.path.join(resultsfolder, 'embeddings', name)
+
+def frameKey(path, content_hash=False):
+    """
+    Key of a frame file: its path, size and modification time, or the sha1 of its content.
+    """
+    if content_hash:
+        with open(path, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    stat = os.stat(path)
+    return f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+def loadEmbeddingStore(folder):
+    keysfile = os.path.join(folder, 'frames.json')
+    embfile = os.path.join(folder, 'embeddings.npy')
+    if not (os.path.exists(keysfile) and os.path.exists(embfile)):
+        return [], None
+    with open(keysfile, 'r') as f:
+        keys = json.load(f)['keys']
+    embeddings = np.load(embfile, mmap_mode='r')
+    if len(keys) != len(embeddings):
+        print(f"Embedding store at {folder} is inconsistent, ignoring it")
+        return [], None
+    return keys, embeddings
+
+def saveEmbeddingStore(folder, keys, embeddings, model=None):
+    os.makedirs(folder, exist_ok=True)
+    keysfile = os.path.join(folder, 'frames.json')
+    embfile = os.path.join(folder, 'embeddings.npy')
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32).reshape(len(keys), -1)
+    with open(f"{embfile}.tmp", 'wb') as f:
+        np.save(f, embeddings)
+    with open(f"{keysfile}.tmp", 'w') as f:
+        json.dump({'model': model, 'dim': embeddings.shape[1], 'nb_frames': len(keys), 'keys': keys}, f)
+    os.replace(f"{embfile}.tmp", embfile)
+    os.replace(f"{keysfile}.tmp", keysfile)
+
+def videoFrameKeys(video_path, nb_frames):
+    """
+    Keys of the frames of a video: its path, size and modification time, and the frame number.
+    """
+    stat = os.stat(video_path)
+    return [f"{os.path.abspath(video_path)}:{stat.st_size}:{stat.st_mtime_ns}:{n}" for n in range(nb_frames)]
+
+def updateEmbeddings(folder, paths, embed, content_hash=False, keys=None, model=None):
+    """
+    Embeddings of the frames at paths, as rows of the (N, D) store.
+    Frames already in the store are reused, embed is called on the list of the other paths and
+    its (n, D) result is added to the store.
+    keys default to the frameKey of each path, paths can be any items when keys are given.
+    Returns the store embeddings, the number of frames that were embedded and the rows of the
+    frames in the store, in path order.
+    """
+    if keys is None:
+        keys = [frameKey(path, content_hash) for path in paths]
+    stored_keys, stored = loadEmbeddingStore(folder)
+    rows = {key: n for n, key in enumerate(stored_keys)}
+
+    missing = {}
+    for path, key in zip(paths, keys):
+        if key not in rows and key not in missing:
+            missing[key] = path
+    print(f"Reusing {len(paths) - len(missing)} stored embeddings from {folder}, computing {len(missing)}")
+
+    if missing:
+        new = np.asarray(embed(list(missing.values())), dtype=np.float32)
+        for key in missing:
+            rows[key] = len(rows)
+        stored_keys = stored_keys + list(missing)
+        stored = new if stored is None else np.concatenate([stored, new])
+        saveEmbeddingStore(folder, stored_keys, stored, model)
+
+    store_rows = np.array([rows[key] for key in keys], dtype=np.int64)
+    return stored, len(missing), store_rows
+
+def loadStoredEmbeddings(folder):
+    """
+    All the embeddings of the store, memory-mapped.
+    """
+    return np.load(os.path.join(folder, 'embeddings.npy'), mmap_mode='r')
+
+def formatName(embedding_format, pca_dim=DEFAULTPCADIM):
+    return f"pca{pca_dim}" if embedding_format == 'pca' else embedding_format
+
+def fitPca(embeddings, dim, sample_size=PCASAMPLE, seed=0):
+    """
+    Mean and first dim principal axes of at most sample_size rows.
+    """
+    rng = np.random.RandomState(seed)
+    sample = np.sort(rng.choice(len(embeddings), size=min(sample_size, len(embeddings)), replace=False))
+    rows = np.asarray(embeddings[sample], dtype=np.float64)
+    mean = rows.mean(axis=0)
+    _, _, axes = np.linalg.svd(rows - mean, full_matrices=False)
+    return mean.astype(np.float32), axes[:dim].astype(np.float32)
+
+def reducedEmbeddings(folder, embedding_format, pca_dim=DEFAULTPCADIM):
+    """
+    Store embeddings in embedding_format, memory-mapped. The float16 or PCA copy is rebuilt
+    block by block when it is missing or behind the store. The PCA axes are fitted once and
+    kept in pca<dim>.npz, rows added later are projected on them.
+    """
+    stored = loadStoredEmbeddings(folder)
+    if embedding_format == 'float32':
+        return stored
+    name = formatName(embedding_format, pca_dim)
+    reducedfile = os.path.join(folder, f"embeddings_{name}.npy")
+    if os.path.exists(reducedfile):
+        reduced = np.load(reducedfile, mmap_mode='r')
+        if len(reduced) == len(stored):
+            return reduced
+
+    if embedding_format == 'pca':
+        pcafile = os.path.join(folder, f"{name}.npz")
+        if os.path.exists(pcafile):
+            pca = np.load(pcafile)
+            mean, axes = pca['mean'], pca['axes']
+        if not os.path.exists(pcafile) or axes.shape[1] != stored.shape[1]:
+            mean, axes = fitPca(stored, pca_dim)
+            with open(f"{pcafile}.tmp", 'wb') as f:
+                np.savez(f, mean=mean, axes=axes)
+            os.replace(f"{pcafile}.tmp", pcafile)
+        transform = lambda rows: (rows - mean) @ axes.T
+        shape, dtype = (len(stored), len(axes)), np.float32
+    else:
+        transform = lambda rows: rows
+        shape, dtype = stored.shape, np.float16
+
+    reduced = np.lib.format.open_memmap(f"{reducedfile}.tmp", mode='w+', dtype=dtype, shape=shape)
+    for i in range(0, len(stored), BLOCKSIZE):
+        reduced[i:i + BLOCKSIZE] = transform(np.asarray(stored[i:i + BLOCKSIZE], dtype=np.float32))
+    reduced.flush()
+    del reduced
+    os.replace(f"{reducedfile}.tmp", reducedfile)
+    print(f"Saved {name} embeddings of shape {shape} at {reducedfile}")
+    return np.load(reducedfile, mmap_mode='r')
+
+def embeddingDistortion(full, reduced, rows, sample_size=DISTORTIONSAMPLE, seed=0):
+    """
+    How well reduced embeddings keep pairwise distances, on the pairs of at most sample_size of
+    the given rows: mean and max relative error and correlation with the full distances.
+    """
+    rng = np.random.RandomState(seed)
+    rows = np.sort(rng.choice(np.unique(rows), size=min(sample_size, len(np.unique(rows))), replace=False))
+    upper = np.triu_indices(len(rows), k=1)
+
+    def pairwise(embeddings):
+        x = np.asarray(embeddings[rows], dtype=np.float64)
+        norms = np.einsum('ij,ij->i', x, x)
+        return np.sqrt(np.maximum(norms[:, None] + norms[None, :] - 2 * (x @ x.T), 0))[upper]
+
+    full_distances = pairwise(full)
+    reduced_distances = pairwise(reduced)
+    errors = np.abs(reduced_distances - full_distances) / np.maximum(full_distances, 1e-12)
+    return {
+        'pairs': len(full_distances),
+        'mean_relative_error': float(errors.mean()) if len(errors) else 0.,
+        'max_relative_error': float(errors.max()) if len(errors) else 0.,
+        'correlation': float(np.corrcoef(full_distances, reduced_distances)[0, 1]) if len(errors) > 1 else 1.,
+    }
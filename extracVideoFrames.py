@@ -1,9 +1,12 @@
 # https://gist.github.com/duhaime/211365edaddf7ff89c0a36d9f3f7956c
 
-import ipdb
-
 import os
+import re
+import json
 import time
+import shutil
+import filecmp
+import tempfile
 import logging
 import warnings
 import itertools
@@ -13,11 +16,13 @@ from glob import glob
 from tqdm import tqdm
 from argparse import ArgumentParser
 
-import cv2
 import numpy as np
-from scipy.stats import wasserstein_distance
-import seaborn as sns
-import matplotlib.pyplot as plt
+
+from videoFrames import countFrames, probeVideo, streamFrames
+from runMetrics import metricsFile, saveMetrics, span, startProfiling
+
+# start time of the MPEG-TS copy checked by --compare-serial
+OFFSETCHECKSECONDS = 1.4
 
 
 def extract_all_frames(video_path, output_folder):
@@ -41,25 +46,252 @@ def extract_all_frames(video_path, output_folder):
     except subprocess.CalledProcessError as e:
         print(f'Error occurred: {e}')
 
+def segment_bounds(nb_frames, nb_segments):
+    """
+    Splits frames 0 to nb_frames - 1 into nb_segments consecutive (first, last) ranges.
+    """
+    edges = np.linspace(0, nb_frames, nb_segments + 1).astype(int)
+    return [(int(first), int(last)) for first, last in zip(edges[:-1], edges[1:]) if last > first]
+
+def extract_segment(video_path, output_folder, first, last, info):
+    """
+    Extracts frames first to last - 1, named with their global number as extract_all_frames does.
+    The segment starts half a frame before frame first with -ss and lasts last - first frames
+    with -t, so consecutive segments neither overlap nor leave gaps. last None runs to the end.
+    ffmpeg already counts -ss from the start time of the file, only the offset of the video
+    stream from it is added.
+    """
+    output_pattern = os.path.join(output_folder, f"%06d.png")
+    command = ['ffmpeg', '-nostdin', '-v', 'error', '-y']
+    if first > 0:
+        command += ['-ss', f"{info['stream_offset'] + (first - 0.5) / info['fps']:.6f}"]
+    command += ['-i', video_path]
+    if last is not None:
+        command += ['-t', f"{(last - first) / info['fps']:.6f}", '-frames:v', str(last - first)]
+    command += ['-start_number', str(first + 1), output_pattern]
+    subprocess.run(command, check=True)
+    return first, last
+
+def extract_all_frames_parallel(video_path, output_folder, workers):
+    """
+    Same images as extract_all_frames, written by workers ffmpeg processes each extracting one
+    time segment of the video.
+    """
+    info = probeVideo(video_path)
+    bounds = segment_bounds(info['nb_frames'], workers)
+    print(f"Extracting {info['nb_frames']} frames in {len(bounds)} segments: {bounds}")
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(
+                extract_segment, video_path, output_folder, first,
+                last if n < len(bounds) - 1 else None, info)
+            for n, (first, last) in enumerate(bounds)]
+        for f in concurrent.futures.as_completed(futures):
+            first, last = f.result()
+            print(f"Extracted frames {first + 1} to {last if last is not None else 'end'}")
+    print(f'Frames extracted successfully to {output_folder}')
+
+def sampling_filters(fps=None, scene_threshold=None):
+    """
+    ffmpeg select filters keeping about fps frames per second and/or the frames whose scene
+    change score is above scene_threshold, the first frame included.
+    """
+    filters = []
+    if scene_threshold is not None:
+        filters.append(f"select='eq(n,0)+gt(scene,{scene_threshold})'")
+    if fps is not None:
+        filters.append(f"select='isnan(prev_selected_t)+gte(t-prev_selected_t,{1 / fps})'")
+    return filters
+
+def extract_sampled_frames(video_path, output_folder, fps=None, keyframes_only=False, scene_threshold=None):
+    """
+    Extracts a subset of the frames, numbered from 1 as extract_all_frames does: only keyframes,
+    which are the only frames decoded, then the scene changes above scene_threshold, then about
+    fps frames per second.
+    Returns, for each image, its source frame index and timestamp in seconds, read from the
+    showinfo filter.
+    """
+    info = probeVideo(video_path)
+    output_pattern = os.path.join(output_folder, f"%06d.png")
+    command = ['ffmpeg', '-nostdin', '-v', 'info', '-y']
+    if keyframes_only:
+        command += ['-skip_frame', 'nokey']
+    command += [
+        '-i', video_path,
+        '-map', '0:v:0',
+        '-vf', ','.join(sampling_filters(fps, scene_threshold) + ['showinfo']),
+        '-vsync', 'vfr',
+        output_pattern
+    ]
+    print(f"RUNNING: {command}")
+    result = subprocess.run(command, check=True, stderr=subprocess.PIPE, text=True)
+
+    frames = []
+    for line in result.stderr.splitlines():
+        match = re.search(r'Parsed_showinfo.*\bpts_time:\s*(\S+)', line)
+        if match is None:
+            continue
+        # decoded timestamps already start from the start time of the file
+        timestamp = float(match.group(1)) - info['stream_offset']
+        frames.append({
+            'image': f"{len(frames) + 1:06d}.png",
+            'iFrame': int(round(timestamp * info['fps'])),
+            'time': timestamp,
+        })
+    print(f'Extracted {len(frames)} frames of {info["nb_frames"]} to {output_folder}')
+    return frames
+
+def save_sampling(jsonfile, video_path, mode, frames):
+    """
+    Sidecar of a sampled extraction, frames[i]['iFrame'] is the source frame index of image i + 1.
+    """
+    with open(jsonfile, 'w') as f:
+        json.dump({'video': video_path, 'mode': mode, 'frames': frames}, f, indent=4)
+    print(f"Sampled frames saved at {jsonfile}")
+
+def verify_frames(video_path, output_folder, nb_expected=None):
+    """
+    Checks that the images are numbered from 1 without gaps and that there is one per frame
+    of the video as counted by ffprobe, or nb_expected of them.
+    """
+    numbers = sorted(int(name[:-4]) for name in os.listdir(output_folder) if name.endswith('.png'))
+    nb_frames = countFrames(video_path) if nb_expected is None else nb_expected
+    gap_free = numbers == list(range(1, len(numbers) + 1))
+    print(f"Found {len(numbers)} images for {nb_frames} frames expected, gap free: {gap_free}")
+    return gap_free and len(numbers) == nb_frames
+
+def compare_with_serial(video_path, output_folder, elapsed):
+    """
+    Extracts the video again with a single ffmpeg process and compares wall-clock times and
+    images with the ones in output_folder, extracted in elapsed seconds.
+    """
+    serial_folder = tempfile.mkdtemp(prefix='serial_', dir=os.path.dirname(os.path.abspath(output_folder)))
+    try:
+        start = time.time()
+        extract_all_frames(video_path, serial_folder)
+        serial_elapsed = time.time() - start
+        names = sorted(os.listdir(serial_folder))
+        same_names = names == sorted(os.listdir(output_folder))
+        _, mismatch, errors = filecmp.cmpfiles(serial_folder, output_folder, names, shallow=False)
+    finally:
+        shutil.rmtree(serial_folder)
+    print(f"Serial extraction took {serial_elapsed} seconds, parallel took {elapsed} seconds "
+          f"({serial_elapsed / max(elapsed, 1e-9):.2f}x)")
+    print(f"Same images as serial extraction: {same_names and not mismatch and not errors} "
+          f"({len(mismatch)} differ, {len(errors)} missing)")
+    return same_names and not mismatch and not errors
+
+def compare_with_offset_copy(video_path, workers, offset=OFFSETCHECKSECONDS):
+    """
+    Remuxes the video to MPEG-TS with its timestamps shifted by offset seconds, as in files whose
+    start time is not zero, and compares the parallel extraction of this copy with a single
+    ffmpeg process.
+    """
+    folder = tempfile.mkdtemp(prefix='offset_')
+    try:
+        offset_copy = os.path.join(folder, 'offset.ts')
+        command = [
+            'ffmpeg', '-nostdin', '-v', 'error', '-y',
+            '-i', video_path,
+            '-map', '0:v:0', '-c', 'copy',
+            '-output_ts_offset', str(offset),
+            offset_copy
+        ]
+        subprocess.run(command, check=True)
+        print(f"Checking a copy of the video starting at {probeVideo(offset_copy)['start_time']} seconds")
+        parallel_folder = os.path.join(folder, 'parallel')
+        os.makedirs(parallel_folder)
+        start = time.time()
+        extract_all_frames_parallel(offset_copy, parallel_folder, workers)
+        same = compare_with_serial(offset_copy, parallel_folder, time.time() - start)
+    finally:
+        shutil.rmtree(folder)
+    return same
+
+def stream_all_frames(video_path):
+    """
+    Decodes every frame into numpy arrays through an ffmpeg pipe, without writing images,
+    and reports the decoding speed.
+    """
+    info = probeVideo(video_path)
+    print(f"Streaming frames of {video_path}: {info}")
+    start = time.time()
+    nb_frames = 0
+    for index, timestamp, frame in tqdm(streamFrames(video_path, info=info), total=info['nb_frames']):
+        nb_frames += 1
+    elapsed = time.time() - start
+    print(f"Decoded {nb_frames} frames in {elapsed} seconds ({nb_frames / max(elapsed, 1e-9)} fps)")
+    return nb_frames
+
 if __name__ == "__main__":
 
     ap = ArgumentParser()
     ap.add_argument(
         '--video', type=str, default="../ForLearning_2025.mp4")
+    ap.add_argument('--stream', action='store_true')
+    ap.add_argument('--workers', type=int, default=1)
+    ap.add_argument('--verify', action='store_true')
+    ap.add_argument('--compare-serial', action='store_true')
+    ap.add_argument('--fps', type=float, default=None)
+    ap.add_argument('--keyframes-only', action='store_true')
+    ap.add_argument('--scene-threshold', type=float, default=None)
+    ap.add_argument('--profile', action='store_true')
 
     args = ap.parse_args()
     video_path = args.video
+    stream = args.stream
+    workers = args.workers
+    verify = args.verify
+    compare_serial = args.compare_serial
+    fps = args.fps
+    keyframes_only = args.keyframes_only
+    scene_threshold = args.scene_threshold
+    sampled = fps is not None or keyframes_only or scene_threshold is not None
+    profile = args.profile
+    profiler = startProfiling() if profile else None
 
     parent_folder, file_path = os.path.split(video_path)
     file_name, extention = file_path.split('.')
     output_folder = os.path.join(parent_folder, file_name)
     os.makedirs(output_folder, exist_ok=True)
-    output_folder_images = os.path.join(parent_folder, file_name, "images")
-    os.makedirs(output_folder_images, exist_ok=True)
 
-    print(f"Extranting images from video {video_path} to folder {output_folder}")
-    extract_all_frames(video_path, output_folder_images)
+    if stream:
+        with span('stream'):
+            stream_all_frames(video_path)
+    else:
+        output_folder_images = os.path.join(parent_folder, file_name, "sampled_images" if sampled else "images")
+        os.makedirs(output_folder_images, exist_ok=True)
+        if sampled:
+            # images of a previous sampling would be mistaken for frames of this one
+            for image in glob(os.path.join(output_folder_images, '*.png')):
+                os.remove(image)
+
+        print(f"Extranting images from video {video_path} to folder {output_folder}")
+        start = time.time()
+        with span('extraction'):
+            frames = None
+            if sampled:
+                # scene scores compare consecutive frames, sampled extraction runs in a single process
+                frames = extract_sampled_frames(
+                    video_path, output_folder_images, fps, keyframes_only, scene_threshold)
+                mode = {'fps': fps, 'keyframes_only': keyframes_only, 'scene_threshold': scene_threshold}
+                save_sampling(os.path.join(output_folder, f"{file_name}_frames.json"), video_path, mode, frames)
+            elif workers > 1:
+                extract_all_frames_parallel(video_path, output_folder_images, workers)
+            else:
+                extract_all_frames(video_path, output_folder_images)
+        elapsed = time.time() - start
+
+        images = glob(os.path.join(output_folder_images, '*'))
+        nb_images = len(images)
+        print(f"Wrote {nb_images} images at {output_folder} in {elapsed} seconds")
 
-    images = glob(os.path.join(output_folder_images, '*'))
-    nb_images = len(images)
-    print(f"Wrote {nb_images} images at {output_folder}")
+        if verify:
+            with span('verify'):
+                verify_frames(video_path, output_folder_images, None if frames is None else len(frames))
+        if compare_serial and not sampled:
+            with span('compare serial'):
+                compare_with_serial(video_path, output_folder_images, elapsed)
+                if workers > 1:
+                    compare_with_offset_copy(video_path, workers)
+    saveMetrics(metricsFile(output_folder, 'extracVideoFrames'), vars(args), profiler)
@@ -0,0 +1,104 @@
+"""
+Figures drawn off the critical path of the scripts.
+
+matplotlib, seaborn and librosa.display are imported by the functions drawing a figure, not at
+module import, so a run that draws nothing never loads them. A FigureWorker renders figures in
+a background process with the Agg backend while the script goes on, from arrays it is given:
+the worker never recomputes anything. close() waits for the figures still being drawn.
+"""
+
+import concurrent.futures
+import multiprocessing
+
+
+def pyplot(interactive=False):
+    """
+    matplotlib.pyplot, on the Agg backend unless figures are to be shown on a display.
+    """
+    import matplotlib
+    if not interactive:
+        matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    return plt
+
+def saveHeatmap(matrix, imgfile, cmap='YlGnBu', title=None):
+    import seaborn as sns
+    plt = pyplot()
+    fig, ax = plt.subplots(figsize=(10,10))
+    annot = True if len(matrix) <= 10 else False
+    heatmap = sns.heatmap(matrix, annot=annot, cmap=cmap, linewidths=0.001, ax=ax)
+    if title is not None:
+        heatmap.set_title(title)
+    fig.savefig(imgfile)
+    plt.close(fig)
+    return imgfile
+
+def saveHistogram(values, imgfile, title):
+    plt = pyplot()
+    fig, ax = plt.subplots()
+    ax.hist(values, bins='auto')
+    ax.set(title=title)
+    fig.savefig(imgfile)
+    plt.close(fig)
+    return imgfile
+
+def saveSpectrograms(mels, mfccs, titles, melfile, mfccfile, fmax=8000):
+    """
+    Mel spectrograms and MFCCs side by side, one column per sound, in two images.
+    """
+    import numpy as np
+    import librosa
+    import librosa.display
+    plt = pyplot()
+
+    fig, axes = plt.subplots(ncols=len(titles), sharex=True, squeeze=False)
+    for ax, mfcc, title in zip(axes[0], mfccs, titles):
+        img = librosa.display.specshow(mfcc, x_axis='time', ax=ax)
+        fig.colorbar(img, ax=[ax])
+        ax.set(title=title)
+    fig.savefig(mfccfile)
+    plt.close(fig)
+
+    fig, axes = plt.subplots(figsize=(16,16), ncols=len(titles), sharex=True, squeeze=False)
+    for ax, mel, title in zip(axes[0], mels, titles):
+        img = librosa.display.specshow(
+            librosa.power_to_db(mel, ref=np.max),
+            x_axis='time', y_axis='mel', fmax=fmax, ax=ax)
+        fig.colorbar(img, ax=[ax])
+        ax.set(title=title)
+    fig.savefig(melfile)
+    plt.close(fig)
+    return melfile
+
+
+class FigureWorker:
+    """
+    One background process drawing the figures submitted to it, started on the first one.
+    The process is spawned, not forked, so it does not inherit the threads of torch or BLAS.
+    """
+
+    def __init__(self):
+        self.executor = None
+        self.futures = []
+
+    def submit(self, draw, *args, **kwargs):
+        if self.executor is None:
+            self.executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=1, mp_context=multiprocessing.get_context('spawn'))
+        self.futures.append(self.executor.submit(draw, *args, **kwargs))
+
+    def close(self):
+        """
+        Wait for the submitted figures. A figure that fails is reported, results saved before
+        it are kept.
+        """
+        if self.executor is None:
+            return
+        for future in self.futures:
+            try:
+                print(f"Figure saved at: {future.result()}")
+            except Exception as e:
+                print(f"Figure failed: {e!r}")
+        self.executor.shutdown()
+        self.executor = None
+        self.futures = []
@@ -0,0 +1,87 @@
+"""
+Near-duplicate frame pruning with 64-bit difference hashes (dHash).
+
+Frames are visited in order and a frame is dropped when its hash is within a Hamming threshold
+of a frame already kept. Kept hashes are indexed by threshold + 1 disjoint chunks of their bits:
+two hashes within the threshold agree exactly on at least one chunk, so only the kept frames
+sharing a chunk value with a new frame are compared to it.
+"""
+
+import json
+import concurrent.futures
+
+import numpy as np
+from PIL import Image
+
+HASHSIZE = 8
+
+
+def dHash(gray):
+    """
+    64-bit difference hash of a grayscale (H, W) uint8 array: signs of the horizontal gradients
+    of the image downsampled to 8 x 9.
+    """
+    small = np.asarray(Image.fromarray(gray).resize((HASHSIZE + 1, HASHSIZE), Image.BILINEAR), dtype=np.int16)
+    bits = (small[:, 1:] > small[:, :-1]).ravel()
+    return int(np.packbits(bits).view('>u8')[0])
+
+def imageHash(path):
+    return dHash(np.asarray(Image.open(path).convert('L')))
+
+def hashImages(paths, workers=None):
+    """
+    Hashes of the images at paths, decoded by a pool of threads.
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(imageHash, paths))
+
+def hammingDistance(a, b):
+    return bin(a ^ b).count('1')
+
+def chunkMasks(threshold, nb_bits=HASHSIZE * HASHSIZE):
+    """
+    (shift, mask) of threshold + 1 disjoint chunks covering the nb_bits bits of a hash.
+    """
+    edges = np.linspace(0, nb_bits, min(threshold + 1, nb_bits) + 1).astype(int)
+    return [(int(a), (1 << int(b - a)) - 1) for a, b in zip(edges[:-1], edges[1:])]
+
+def pruneNearDuplicates(hashes, threshold):
+    """
+    Greedy pruning of hashes in order. A hash is kept unless it is within threshold bits of a
+    kept one, the first found in order of the kept frames.
+    Returns the positions of the kept hashes and, for every hash, the position of the kept
+    hash standing for it.
+    """
+    chunks = chunkMasks(threshold)
+    buckets = [{} for _ in chunks]
+    kept = []
+    representatives = []
+    for n, h in enumerate(hashes):
+        candidates = set()
+        for (shift, mask), bucket in zip(chunks, buckets):
+            candidates.update(bucket.get((h >> shift) & mask, ()))
+        matches = [k for k in sorted(candidates) if hammingDistance(h, hashes[k]) <= threshold]
+        if matches:
+            representatives.append(matches[0])
+            continue
+        kept.append(n)
+        representatives.append(n)
+        for (shift, mask), bucket in zip(chunks, buckets):
+            bucket.setdefault((h >> shift) & mask, []).append(n)
+    return kept, representatives
+
+def savePruning(jsonfile, names, hashes, kept, representatives, threshold):
+    """
+    Kept frames and, for every original frame, the kept frame standing for it.
+    """
+    pruning = {
+        'threshold': threshold,
+        'kept': [names[k] for k in kept],
+        'frames': [
+            {'image': names[n], 'index': n, 'hash': f"{hashes[n]:016x}",
+             'kept': names[r], 'keptIndex': r}
+            for n, r in enumerate(representatives)],
+    }
+    with open(jsonfile, 'w') as f:
+        json.dump(pruning, f, indent=4)
+    print(f"Kept {len(kept)} of {len(names)} frames within {threshold} bits, mapping saved at {jsonfile}")
@@ -2,22 +2,29 @@ import os
 import json
 import time
 import itertools
+import concurrent.futures
+from collections import deque
 from tqdm import tqdm
 from glob import glob
-from copy import deepcopy
 from argparse import ArgumentParser
 
 import numpy as np
 from PIL import Image
-from scipy.spatial import distance_matrix
 
 import pandas as pd
-import seaborn as sns
-import matplotlib.pyplot as plt
 
 DEFAULTNBFINALIMAGES = 10
 DEFAULTMAXNBSTEPS = 500
+DEFAULTCANDIDATESPERSTEP = 1
+DEFAULTINIT = 'random'
+DEFAULTEXACTMAXNODES = 1000000
+DEFAULTEXACTMAXIMAGES = 2000
+DEFAULTRESTARTS = 1
 DEFAULTSEED = 1334
+DEFAULTBATCHSIZE = 32
+DEFAULTLOADERS = 4
+DEFAULTBLOCKSIZE = 2048
+DEFAULTHEATMAPBINS = 512
 
 # DEFAULTRESULTSFOLDER = "/home/jimena/work/dev/artex/results/ForLearning_2025-10-03_19-47-53"
 # DEFAULTIMAGEFOLDER = "/home/jimena/work/dev/artex/ForLearning_2025-10-03_19-47-53/images"
@@ -32,138 +39,301 @@ DEFAULTPARAMSPATH = "/home/jimena/work/dev/ARTEX/ForLearning_2025-10-03_19-47-53
 DEFAULTREPO = 'facebookresearch/dino:main'
 DEFAULTMODEL = 'dino_resnet50'
 
-import ipdb
 import warnings
 warnings.filterwarnings('ignore')
 
-def compute_features(model, path):
-    preprocess = pth_transforms.Compose([
+from maxMinSearch import exactMaxMin, farthestPointInit, minDistance, parallelRestarts, saveRestartSummary, swapSearch
+from embeddingStore import (DEFAULTPCADIM, EMBEDDINGFORMATS, embeddingDistortion, formatName, loadStoredEmbeddings,
+                            reducedEmbeddings, storeFolder, updateEmbeddings, videoFrameKeys)
+from embeddingIndex import DEFAULTNPROBE, updateIndex
+from videoFrames import frameName, probeVideo, saveFrames, streamFrames
+from frameHashes import dHash, hashImages, pruneNearDuplicates, savePruning
+from runMetrics import metricsFile, record, saveMetrics, span, startProfiling
+from figureWorker import FigureWorker, pyplot, saveHeatmap, saveHistogram
+from selectionExport import placeFiles, saveManifest
+
+def getPreprocess():
+    from torchvision import transforms as pth_transforms
+    return pth_transforms.Compose([
             pth_transforms.Resize(256, interpolation=3),
             pth_transforms.CenterCrop(224),
             pth_transforms.ToTensor(),
             pth_transforms.Normalize((0.485, 0.456, 0.406), (0.229, 0.224, 0.225)),
         ])
 
-    def get_features(model, image):
-      return model(preprocess(image).unsqueeze(0))
-
-    return get_features(resnet50, Image.open(path)).detach().numpy()
+def loadAndPreprocess(path, preprocess):
+    start = time.time()
+    image = Image.open(path).convert('RGB')
+    decoded = time.time()
+    tensor = preprocess(image)
+    return tensor, decoded - start, time.time() - decoded
+
+def preprocessFrame(frame, preprocess):
+    start = time.time()
+    tensor = preprocess(Image.fromarray(frame))
+    return tensor, 0., time.time() - start
+
+def iterBatches(items, batch_size):
+    items = iter(items)
+    while True:
+        batch = list(itertools.islice(items, batch_size))
+        if not batch:
+            return
+        yield batch
+
+def computeEmbeddings(model, paths, batch_size=DEFAULTBATCHSIZE, loaders=DEFAULTLOADERS, prefetch=2,
+                      load=loadAndPreprocess):
+    """
+    Embeddings of the images at paths as a float32 (N, D) array.
+    A pool of loader threads decodes and preprocesses up to prefetch batches ahead of the
+    forward pass, which runs batched under torch.inference_mode().
+    paths can be any iterable, e.g. of frames streamed from a video with load=preprocessFrame,
+    it is only read prefetch batches ahead.
+    """
+    import torch
+
+    preprocess = getPreprocess()
+    model.eval()
+    batches = iterBatches(paths, batch_size)
+    timings = {'decode': 0., 'preprocess': 0., 'forward': 0.}
+    outputs = []
+    nb_images = 0
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=loaders) as executor, \
+            tqdm(total=len(paths) if hasattr(paths, '__len__') else None) as progress:
+        submit = lambda batch: [executor.submit(load, path, preprocess) for path in batch]
+        pending = deque(submit(batch) for batch in itertools.islice(batches, prefetch))
+        while pending:
+            futures = pending.popleft()
+            batch = next(batches, None)
+            if batch is not None:
+                pending.append(submit(batch))
+            results = [f.result() for f in futures]
+            timings['decode'] += sum(r[1] for r in results)
+            timings['preprocess'] += sum(r[2] for r in results)
+
+            start = time.time()
+            with torch.inference_mode():
+                output = model(torch.stack([r[0] for r in results]))
+            output = output.float().numpy().reshape(len(results), -1)
+            timings['forward'] += time.time() - start
+
+            outputs.append(output.astype(np.float32))
+            nb_images += len(output)
+            progress.update(len(output))
+
+    print(f"Decoding {nb_images} images took {timings['decode']} seconds (summed over {loaders} loaders).")
+    print(f"Preprocessing {nb_images} images took {timings['preprocess']} seconds (summed over {loaders} loaders).")
+    print(f"Forward passes with batch size {batch_size} took {timings['forward']} seconds.")
+    record('embedding seconds', timings)
+    return np.concatenate(outputs) if outputs else np.zeros((0, 0), dtype=np.float32)
+
+def blockedDistanceMatrix(embeddings, npfile, block_size=DEFAULTBLOCKSIZE):
+    """
+    Pairwise euclidean distances written tile by tile to a float32 (N, N) memory-mapped .npy file.
+    Tiles are computed in float32 as sqrt(|a|^2 + |b|^2 - 2ab), only for the upper triangle and
+    mirrored, so memory stays around a few block_size x block_size tiles whatever N is.
+    float16 embeddings stay float16, each block is upcast when it is used.
+    """
+    nb = len(embeddings)
+    block = lambda begin: np.asarray(embeddings[begin:begin + block_size], dtype=np.float32)
+    norms = np.concatenate(
+        [np.einsum('ij,ij->i', block(i), block(i)) for i in range(0, nb, block_size)] or [np.zeros(0, dtype=np.float32)])
+    distances = np.lib.format.open_memmap(npfile, mode='w+', dtype=np.float32, shape=(nb, nb))
+    for i in range(0, nb, block_size):
+        a = block(i)
+        for j in range(i, nb, block_size):
+            b = block(j)
+            tile = norms[i:i + block_size, None] + norms[None, j:j + block_size] - 2 * (a @ b.T)
+            np.sqrt(np.maximum(tile, 0, out=tile), out=tile)
+            if i == j:
+                np.fill_diagonal(tile, 0)
+            distances[i:i + block_size, j:j + block_size] = tile
+            if i != j:
+                distances[j:j + block_size, i:i + block_size] = tile.T
+    distances.flush()
+    return distances
 
-def imagesDistanceMatrix(embeddings, folder, name):
+def binnedDistances(distances, bins=DEFAULTHEATMAPBINS, block_size=DEFAULTBLOCKSIZE):
+    """
+    Block means of a distance matrix down to at most bins x bins, read a few rows at a time.
+    """
+    nb = len(distances)
+    if nb <= bins:
+        return np.asarray(distances)
+    edges = np.linspace(0, nb, bins + 1).astype(int)
+    counts = np.diff(edges)
+    binned = np.zeros((bins, bins))
+    for i in range(0, nb, block_size):
+        rows = np.asarray(distances[i:i + block_size], dtype=np.float64)
+        columns = np.add.reduceat(rows, edges[:-1], axis=1)
+        row_bins = np.searchsorted(edges, np.arange(i, i + len(rows)), side='right') - 1
+        np.add.at(binned, row_bins, columns)
+    return binned / counts[:, None] / counts[None, :]
+
+def imagesDistanceMatrix(embeddings, folder, name, block_size=DEFAULTBLOCKSIZE, csv=True, heatmap=True,
+                         figures=None):
 
     os.makedirs(folder, exist_ok=True)
 
-    distances = distance_matrix(x=embeddings, y=embeddings)
-    # print(f"distance:\n{distances}")
-
     npfile = os.path.join(folder, f"{name}.npy")
-    with open(npfile, 'wb') as f:
-        np.save(f, distances)
+    distances = blockedDistanceMatrix(embeddings, npfile, block_size)
     print(f"Distance matrix array saved at: {npfile}")
 
-    csvfile = os.path.join(folder, f"{name}.csv")
-    pd.DataFrame(distances).to_csv(csvfile, index=False)
-    print(f"Distance matrix csv saved at: {csvfile}")
+    if csv:
+        csvfile = os.path.join(folder, f"{name}.csv")
+        for i in range(0, len(distances), block_size):
+            rows = pd.DataFrame(distances[i:i + block_size])
+            rows.to_csv(csvfile, index=False, header=(i == 0), mode='w' if i == 0 else 'a')
+        print(f"Distance matrix csv saved at: {csvfile}")
 
-    fig, ax = plt.subplots(figsize=(10,10))
-    annot = True if len(embeddings) <= 10 else False
-    heatmap = sns.heatmap(distances, annot=annot, cmap='YlGnBu', linewidths=0.001, ax=ax)
+    if not heatmap:
+        return distances
 
     imgfile = os.path.join(folder, f"{name}.png")
-    heatmap.get_figure().savefig(imgfile)
-    print(f"Distance matrix image saved at: {imgfile}")
+    binned = binnedDistances(distances, block_size=block_size)
+    if figures is None:
+        saveHeatmap(binned, imgfile)
+        print(f"Distance matrix image saved at: {imgfile}")
+    else:
+        figures.submit(saveHeatmap, binned, imgfile)
 
     return distances
 
 
-def pairsFind(distmatrix, allembeddings, finalnbimages):
+def pairsFind(distmatrix, allembeddings, finalnbimages, nbsteps=DEFAULTMAXNBSTEPS,
+              candidates_per_step=DEFAULTCANDIDATESPERSTEP, init=DEFAULTINIT,
+              exact=False, exact_max_nodes=DEFAULTEXACTMAXNODES, checkpoint=None, resume=False):
 
     nb_images = allembeddings.shape[0]
-    indexes = np.random.choice(nb_images, size=finalnbimages, replace=False).tolist()
-
-    embeddings = allembeddings[indexes]
-    aux_distance = distance_matrix(x=embeddings, y=embeddings) + 1e9 * np.eye(finalnbimages)
-    min_distance = aux_distance.min()
-    print(f"Current indexes are {indexes}")
-    print(f"Current min distance is {min_distance}")
+    report = []
 
-    eject_a, eject_b = np.unravel_index(aux_distance.argmin(), aux_distance.shape)
-    if aux_distance[eject_a].min() < aux_distance[eject_b].min():
-        eject = int(eject_a)
+    start = time.time()
+    if init == 'greedy':
+        indexes = farthestPointInit(allembeddings, finalnbimages)
     else:
-        eject = int(eject_b)
-    print(f"Ejecting candidate is located at index {eject}")
-
-    new_cadidate = np.random.choice(nb_images, size=1, replace=False).tolist()[0]
-    print(f"New candidate is {new_cadidate}")
-
-    new_indexes = deepcopy(indexes)
-    new_indexes[eject] = new_cadidate
-    new_embeddings = allembeddings[new_indexes]
-    new_aux_distance = distance_matrix(x=new_embeddings, y=new_embeddings) + 1e9 * np.eye(finalnbimages)
-    new_min_distance = new_aux_distance.min()
-    print(f"New indexes are {new_indexes}")
-    print(f"New  min distance is {new_min_distance}")
-
-    if new_min_distance > min_distance:
-        indexes = new_indexes
-        print(f"Updating indexes to new ones")
-
-    for _ in tqdm(range(nbsteps)):
-        embeddings = allembeddings[indexes]
-        aux_distance = distance_matrix(x=embeddings, y=embeddings) + 1e9 * np.eye(finalnbimages)
-        min_distance = aux_distance.min()
-
-        eject_a, eject_b = np.unravel_index(aux_distance.argmin(), aux_distance.shape)
-        if aux_distance[eject_a].min() < aux_distance[eject_b].min():
-            eject = int(eject_a)
-        else:
-            eject = int(eject_b)
-        # print(f"Ejecting candidate is located at index {eject}")
-
-        new_cadidate = np.random.choice(nb_images, size=1, replace=False).tolist()[0]
-        # print(f"New candidate is {new_cadidate}")
-
-        new_indexes = deepcopy(indexes)
-        new_indexes[eject] = new_cadidate
-        new_embeddings = allembeddings[new_indexes]
-        new_aux_distance = distance_matrix(x=new_embeddings, y=new_embeddings) + 1e9 * np.eye(finalnbimages)
-        new_min_distance = new_aux_distance.min()
-        # print(f"New indexes are {new_indexes}")
-        # print(f"New  min distance is {new_min_distance}")
-
-        if new_min_distance > min_distance:
-            indexes = new_indexes
-            min_distance = new_min_distance
-            print(f"New min distance found at step {_}")
-            print(f"Updating indexes to new ones. New min distance is {min_distance}")
+        indexes = np.random.choice(nb_images, size=finalnbimages, replace=False)
+    min_distance = minDistance(allembeddings[indexes])
+    report.append((f"{init} init", min_distance, time.time() - start))
 
+    if nbsteps > 0:
+        start = time.time()
+        indexes, min_distance = swapSearch(
+            lambda idx: allembeddings[idx], nb_images, indexes, nbsteps,
+            candidates_per_step=candidates_per_step, progress=True, checkpoint=checkpoint, resume=resume)
+        report.append((f"{init} init + {nbsteps} swap steps", min_distance, time.time() - start))
+
+    if exact and nb_images > DEFAULTEXACTMAXIMAGES:
+        print(f"Skipping exact solver, {nb_images} images is more than {DEFAULTEXACTMAXIMAGES}")
+    elif exact:
+        heuristic_distance = min_distance
+        start = time.time()
+        indexes, _, proven = exactMaxMin(distmatrix, finalnbimages, indexes, exact_max_nodes)
+        min_distance = minDistance(allembeddings[indexes])
+        name = "exact" if proven else f"bounded exact ({exact_max_nodes} nodes)"
+        report.append((name, min_distance, time.time() - start))
+        if proven:
+            print(f"The heuristic reaches {100 * heuristic_distance / min_distance:.2f}% of the optimal min distance")
+
+    print(f"{'strategy':<40}{'min distance':>16}{'seconds':>12}")
+    for name, distance, elapsed in report:
+        print(f"{name:<40}{distance:>16.6f}{elapsed:>12.3f}")
+
+    indexes = [int(i) for i in indexes]
     print(f"Final indexes are: {indexes}")
     print(f"Final min distance is: {min_distance}")
 
     return indexes
 
+def selectionNeighbours(index, store_rows, indexes, allimages, radius, nprobe=DEFAULTNPROBE):
+    """
+    Nearest other candidate of each selected image and number of other candidates within radius,
+    answered by the index over the store. store_rows are the store rows of the candidates.
+    """
+    allowed = np.zeros(len(index), dtype=bool)
+    allowed[store_rows] = True
+    candidate = {int(row): n for n, row in enumerate(store_rows)}
+    queries = np.asarray(index.embeddings[store_rows[indexes]], dtype=np.float32)
+    distances, rows = index.knn(queries, 2, nprobe, allowed)
+
+    neighbours = []
+    for n, i in enumerate(indexes):
+        others = [(d, r) for d, r in zip(distances[n], rows[n]) if r not in (store_rows[i], -1)]
+        nearest_distance, nearest_row = others[0] if others else (np.inf, -1)
+        within, _ = index.radius(queries[n], radius, allowed)
+        nearest_image = allimages[candidate[int(nearest_row)]] if nearest_row >= 0 else ''
+        neighbours.append((allimages[i], nearest_image, float(nearest_distance), len(within) - 1))
+    return neighbours
+
 if __name__ == "__main__":
 
     ap = ArgumentParser()
     ap.add_argument('--image_folder', type=str, default=DEFAULTIMAGEFOLDER)
+    ap.add_argument('--video', type=str, default=None)
     ap.add_argument('--params', type=str, default=DEFAULTPARAMSPATH)
     ap.add_argument('--repository', type=str, default=DEFAULTREPO)
     ap.add_argument('--model', type=str, default=DEFAULTMODEL)
     ap.add_argument('--finalnbimages', type=int, default=DEFAULTNBFINALIMAGES)
     ap.add_argument('--nbsteps', type=int, default=DEFAULTMAXNBSTEPS)
+    ap.add_argument('--candidates-per-step', type=int, default=DEFAULTCANDIDATESPERSTEP)
+    ap.add_argument('--init', type=str, choices=['random', 'greedy'], default=DEFAULTINIT)
+    ap.add_argument('--exact', action='store_true')
+    ap.add_argument('--exact-max-nodes', type=int, default=DEFAULTEXACTMAXNODES)
+    ap.add_argument('--restarts', type=int, default=DEFAULTRESTARTS)
+    ap.add_argument('--workers', type=int, default=None)
     ap.add_argument('--resultsfolder', type=str, default=DEFAULTRESULTSFOLDER)
     ap.add_argument('--seed', type=int, default=DEFAULTSEED)
+    ap.add_argument('--batch-size', type=int, default=DEFAULTBATCHSIZE)
+    ap.add_argument('--loaders', type=int, default=DEFAULTLOADERS)
+    ap.add_argument('--hash-frames', action='store_true')
+    ap.add_argument('--dedup-threshold', type=int, default=None)
+    ap.add_argument('--block-size', type=int, default=DEFAULTBLOCKSIZE)
+    ap.add_argument('--csv', action='store_true')
+    ap.add_argument('--heatmap', action='store_true')
+    ap.add_argument('--embedding-format', type=str, choices=EMBEDDINGFORMATS, default='float32')
+    ap.add_argument('--pca-dim', type=int, default=DEFAULTPCADIM)
+    ap.add_argument('--index', action='store_true')
+    ap.add_argument('--nprobe', type=int, default=DEFAULTNPROBE)
+    ap.add_argument('--profile', action='store_true')
+    ap.add_argument('--headless', action='store_true')
+    ap.add_argument('--resume', action='store_true')
+    ap.add_argument('--hardlink-export', action='store_true')
 
     args = ap.parse_args()
+    if args.exact and args.restarts > 1:
+        ap.error("--exact runs on a single search, it cannot be combined with --restarts")
     image_folder = args.image_folder
+    video = args.video
     params = args.params
     repository = args.repository
     model = args.model
     finalnbimages = args.finalnbimages
     nbsteps = args.nbsteps
+    candidates_per_step = args.candidates_per_step
+    init = args.init
+    exact = args.exact
+    exact_max_nodes = args.exact_max_nodes
+    restarts = args.restarts
+    workers = args.workers
     resultsfolder = args.resultsfolder
     seed = args.seed
+    batch_size = args.batch_size
+    loaders = args.loaders
+    hash_frames = args.hash_frames
+    dedup_threshold = args.dedup_threshold
+    block_size = args.block_size
+    csv = args.csv
+    heatmap = args.heatmap
+    embedding_format = args.embedding_format
+    pca_dim = args.pca_dim
+    use_index = args.index
+    nprobe = args.nprobe
+    profile = args.profile
+    headless = args.headless
+    resume = args.resume
+    hardlink_export = args.hardlink_export
+    profiler = startProfiling() if profile else None
+    figures = FigureWorker()
 
 
     parameters = vars(args)
@@ -176,60 +346,141 @@ if __name__ == "__main__":
         params = json.load(f)
 
     np.random.seed(seed)
-    print(f"Computing embeddings from images in {image_folder} using {model}.")
-
-    allimages = glob(os.path.join(image_folder, '*.png'))
-    allimages.sort()
-
-    embfile = os.path.join(resultsfolder, f"embeddings.npy")
-    filesname = os.path.join(resultsfolder, f"emb_distance_matrix")
-    disfile = f"{filesname}.npy"
-    if os.path.exists(embfile):
-        print(f"Loading embeddings from {embfile}")
-        with open(embfile, 'rb') as f:
-            allembeddings = np.load(f)
-        print(f"Loading distance matrix from {disfile}")
-        with open(disfile, 'rb') as f:
-            alldistances = np.load(f)
-    else:
 
+    if video is None:
+        print(f"Computing embeddings from images in {image_folder} using {model}.")
+        allimages = glob(os.path.join(image_folder, '*.png'))
+        allimages.sort()
+        items, keys = allimages, None
+    else:
+        # frames are streamed from the video, only the selected ones are written as png
+        print(f"Computing embeddings from frames of {video} using {model}.")
+        info = probeVideo(video)
+        allimages = [f"{frameName(n)}.png" for n in range(info['nb_frames'])]
+        items, keys = list(range(info['nb_frames'])), videoFrameKeys(video, info['nb_frames'])
+
+    # position of each candidate among all the frames
+    frame_indexes = list(range(len(allimages)))
+    if dedup_threshold is not None:
+        start = time.time()
+        with span('dedup'):
+            if video is None:
+                hashes = hashImages(allimages, loaders)
+            else:
+                frames = itertools.islice(streamFrames(video, pix_fmt='gray', info=info), len(allimages))
+                hashes = [dHash(frame) for _, _, frame in frames]
+            frame_indexes, representatives = pruneNearDuplicates(hashes, dedup_threshold)
+        print(f"Hashing and pruning {len(hashes)} frames took {time.time() - start} seconds.")
+        os.makedirs(resultsfolder, exist_ok=True)
+        prunefile = os.path.join(resultsfolder, f"kept_frames_DEDUP_{dedup_threshold}.json")
+        savePruning(prunefile, allimages, hashes, frame_indexes, representatives, dedup_threshold)
+        allimages = [allimages[n] for n in frame_indexes]
+        items = [items[n] for n in frame_indexes]
+        keys = None if keys is None else [keys[n] for n in frame_indexes]
+
+    def embed(items):
         import torch
-        from torchvision import transforms as pth_transforms
 
         resnet50 = torch.hub.load(repo_or_dir=repository, model=model)
         start = time.time()
-        allembeddings = []
-
-        for image in tqdm(allimages):
-            allembeddings.append(compute_features(resnet50, image))
-        nb_images = np.array(allembeddings).squeeze()
-        print(f"Calculing {len(nb_images)} embeddings took {time.time() - start} seconds.")
-        print(f"Saving embeddings to {embfile}")
-
-        with open(embfile, 'wb') as f:
-            np.save(f, allembeddings)
-        alldistances = imagesDistanceMatrix(allembeddings, resultsfolder, f"{video}_emb_distance_matrix")
-
-        plt.hist(alldistances.flatten(), bins='auto')
-        plt.title("Distances histogram")
-        plt.show()
+        if video is None:
+            embeddings = computeEmbeddings(resnet50, items, batch_size, loaders)
+        else:
+            wanted = set(items)
+            frames = (frame for n, _, frame in streamFrames(video, info=info) if n in wanted)
+            embeddings = computeEmbeddings(resnet50, frames, batch_size, loaders, load=preprocessFrame)
+            if len(embeddings) != len(items):
+                raise ValueError(f"Expected {len(items)} frames from {video}, decoded {len(embeddings)}")
+        print(f"Calculing {len(embeddings)} embeddings took {time.time() - start} seconds.")
+        return embeddings
+
+    embfolder = storeFolder(resultsfolder, repository, model)
+    with span('embeddings'):
+        storedembeddings, nb_embedded, store_rows = updateEmbeddings(
+            embfolder, items, embed, content_hash=hash_frames, keys=keys, model=f"{repository}/{model}")
+
+    # distances and search run on the float32, float16 or PCA-reduced embeddings
+    format_name = formatName(embedding_format, pca_dim)
+    if embedding_format != 'float32':
+        start = time.time()
+        with span('reduced embeddings'):
+            storedembeddings = reducedEmbeddings(embfolder, embedding_format, pca_dim)
+        print(f"Loading {format_name} embeddings took {time.time() - start} seconds.")
+        distortion = embeddingDistortion(loadStoredEmbeddings(embfolder), storedembeddings, store_rows)
+        print(f"Distortion of {format_name} distances: {distortion}")
+    # float16 candidates stay float16, distances upcast them block by block and the search per lookup
+    allembeddings = np.asarray(storedembeddings[store_rows])
+
+    if use_index:
+        start = time.time()
+        with span('index'):
+            index = updateIndex(embfolder, storedembeddings, "index" if embedding_format == 'float32' else f"index_{format_name}")
+        print(f"Loading the embedding index took {time.time() - start} seconds.")
+
+    disname = "emb_distance_matrix" if dedup_threshold is None else f"emb_distance_matrix_DEDUP_{dedup_threshold}"
+    if embedding_format != 'float32':
+        disname = f"{disname}_{format_name}"
+    disfile = os.path.join(embfolder, f"{disname}.npy")
+    # store rows of the matrix, a cached matrix is only reused for exactly the same candidates
+    rowsfile = os.path.join(embfolder, f"{disname}_rows.npy")
+    alldistances = None
+    if nb_embedded == 0 and os.path.exists(disfile) and os.path.exists(rowsfile):
+        if np.array_equal(np.load(rowsfile), store_rows):
+            alldistances = np.load(disfile, mmap_mode='r')
+            print(f"Loaded distance matrix from {disfile}")
+    if alldistances is None:
+        if os.path.exists(rowsfile):
+            os.remove(rowsfile)
+        with span('distance matrix'):
+            alldistances = imagesDistanceMatrix(
+                allembeddings, embfolder, disname, block_size, csv=csv, heatmap=heatmap, figures=figures)
+        np.save(rowsfile, np.asarray(store_rows))
+
+        # histogram over at most ~1000 rows of the matrix
+        step = max(1, len(alldistances) // 1000)
+        values = np.asarray(alldistances[::step]).flatten()
+        if headless:
+            figures.submit(saveHistogram, values, os.path.join(embfolder, f"{disname}_histogram.png"), "Distances histogram")
+        else:
+            plt = pyplot(interactive=True)
+            plt.hist(values, bins='auto')
+            plt.title("Distances histogram")
+            plt.show()
 
     print(f"Embeddings shape are: {allembeddings.shape}")
 
     print("\n\n---------------------------------------------------------")
     print(f"PAIRS FIND ALGO")
-    indexes = pairsFind(alldistances, allembeddings, finalnbimages)
+    # the search state is checkpointed next to the results, per set of candidates and seed
+    checkpointfile = os.path.join(resultsfolder, f"checkpoint_{disname}_NBIMAGES_{finalnbimages}_SEED_{seed}.npz")
+    with span('search'):
+        if restarts > 1 and resume:
+            print(f"Restarts are not checkpointed, running them from the start.")
+        if restarts > 1:
+            seeds = list(range(seed, seed + restarts))
+            seed, indexes, min_distance, summary = parallelRestarts(
+                allembeddings, finalnbimages, seeds, nbsteps, candidates_per_step, init, workers)
+            indexes = [int(i) for i in indexes]
+            summaryfile = os.path.join(
+                resultsfolder, f"restarts_NBIMAGES_{finalnbimages}_SEEDS_{seeds[0]}_{seeds[-1]}.csv")
+            saveRestartSummary(summary, summaryfile)
+            print(f"Best seed is {seed} with min distance {min_distance}")
+        else:
+            indexes = pairsFind(
+                alldistances, allembeddings, finalnbimages, nbsteps, candidates_per_step,
+                init=init, exact=exact, exact_max_nodes=exact_max_nodes, checkpoint=checkpointfile, resume=resume)
+    record('min distance', float(minDistance(allembeddings[indexes])))
     print("---------------------------------------------------------")
 
     # get images, embeddings and iFrames from indexes
     selected_images = [allimages[i] for i in indexes]
     selected_embeddings = allembeddings[indexes]
-    selected_iFrames = [params['frames'][i]['iFrame'] for i in indexes]
+    selected_iFrames = [params['frames'][frame_indexes[i]]['iFrame'] for i in indexes]
 
     # reorder selected images
     name = f"selected_embeddings_distance_matrix"
     selected_results_folder = os.path.join(resultsfolder, f"NBIMAGES_{finalnbimages}_SEED_{seed}")
-    distances = imagesDistanceMatrix(selected_embeddings, selected_results_folder, name)
+    distances = imagesDistanceMatrix(selected_embeddings, selected_results_folder, name, figures=figures)
     aux_distances = distances + 1e9 * np.eye(finalnbimages)
     min_distance = aux_distances.min(axis=0)
     ordered_indexes = np.flip(np.argsort(min_distance))
@@ -239,19 +490,49 @@ if __name__ == "__main__":
 
     print(f"Final ordered indexes are: {ordered_indexes}")
 
+    if use_index:
+        # candidates closer to a selected image than half the min distance are covered by it
+        radius = min_distance.min() / 2
+        neighbours = selectionNeighbours(
+            index, store_rows, [indexes[i] for i in ordered_indexes], allimages, radius, nprobe)
+        neighboursfile = os.path.join(selected_results_folder, "selected_neighbours.csv")
+        pd.DataFrame(neighbours, columns=['image', 'nearest_image', 'nearest_distance', f"within_{radius}"]).to_csv(
+            neighboursfile, index=False)
+        print(f"Nearest candidates of the selected images saved at {neighboursfile}")
+
     # save results
     name = f"selected_images"
     selected_images_folder = os.path.join(selected_results_folder, name)
     os.makedirs(selected_images_folder, exist_ok=True)
-    for n, (iFrame, image) in enumerate(zip(ordered_selected_iFrames, ordered_selected_images)):
-        newimgfile = f"image_nb_{n}_iFrame_{iFrame}_frame_{os.path.split(image)[1][:-4]}.png"
-        os.system(f"cp {image} {selected_images_folder}/{newimgfile}")
-
+    newimgfiles = [
+        f"image_nb_{n}_iFrame_{iFrame}_frame_{os.path.split(image)[1][:-4]}.png"
+        for n, (iFrame, image) in enumerate(zip(ordered_selected_iFrames, ordered_selected_images))]
+    with span('export'):
+        if video is None:
+            methods = placeFiles(
+                ordered_selected_images, [os.path.join(selected_images_folder, f) for f in newimgfiles], loaders,
+                hardlink=hardlink_export)
+        else:
+            saveFrames(video, [frame_indexes[indexes[i]] for i in ordered_indexes], selected_images_folder, newimgfiles)
+            methods = ['decoded'] * len(newimgfiles)
+        print(f"Selected images placed at {selected_images_folder} ({', '.join(sorted(set(methods)))})")
+
+        selection = [
+            {'rank': n, 'image': ordered_selected_images[n], 'file': newimgfiles[n], 'export': methods[n],
+             'iFrame': ordered_selected_iFrames[n], 'frame': int(frame_indexes[indexes[i]]),
+             'min_distance': float(min_distance[i])}
+            for n, i in enumerate(ordered_indexes)]
+        saveManifest(
+            os.path.join(selected_results_folder, "selection_manifest.json"), 'imageEmbeddingsMaxDistances',
+            parameters, selection, model=model, embedding_format=format_name, min_distance=float(min_distance.min()))
 
     name = f"selected_iFrames_NBIMAGES_{finalnbimages}_SEED_{seed}"
     resfile = os.path.join(selected_results_folder,f"{name}.txt")
     with open(resfile, 'w') as f:
         f.writelines('\n'.join(map(str, ordered_selected_iFrames))+'\n')
     print(f"Final iFrames saved at {resfile}:\niFrames")
+    saveMetrics(metricsFile(selected_results_folder, 'imageEmbeddingsMaxDistances'), parameters, profiler)
+    figures.close()
 
-    os.system(f"open {selected_images_folder}/")
+    if not headless:
+        os.system(f"open {selected_images_folder}/")
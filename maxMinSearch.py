@@ -0,0 +1,340 @@
+"""
+Max-min distance selection shared by imageEmbeddingsMaxDistances.py and soundMfccMaxDistances.py.
+
+A selection of k items is improved by swapping out one member of its closest pair for the best of
+a few random candidates, keeping the swap only if the min pairwise distance grows.
+
+The search state (indexes, step, state of the numpy random generator and accepted swaps) can be
+checkpointed every few seconds and resumed: a resumed search draws the same candidates and ends
+with the same selection as an uninterrupted one.
+"""
+
+import io
+import os
+import time
+import contextlib
+import concurrent.futures
+
+import numpy as np
+from scipy.spatial import distance_matrix
+
+from sharedArrays import fromSharedMemory, toSharedMemory
+from runMetrics import count, record, span
+
+DIAGONAL = 1e9
+DEFAULTCHECKPOINTSECONDS = 5
+FEATUREBLOCKSIZE = 65536
+
+
+def auxDistanceMatrix(features):
+    """
+    Pairwise distance matrix of a selection with the diagonal pushed away, in float64.
+    """
+    features = np.asarray(features, dtype=np.float64)
+    return distance_matrix(x=features, y=features) + DIAGONAL * np.eye(len(features))
+
+def nearestNeighbours(aux_distance):
+    """
+    Distance to, and position of, the nearest other member for each member of the selection.
+    """
+    nearest_idx = aux_distance.argmin(axis=1)
+    nearest = aux_distance[np.arange(len(aux_distance)), nearest_idx]
+    return nearest, nearest_idx
+
+def chooseEject(nearest, nearest_idx):
+    """
+    Member of the closest pair to swap out, same rule as on the full distance matrix.
+    """
+    eject_a = int(nearest.argmin())
+    eject_b = int(nearest_idx[eject_a])
+    if nearest[eject_a] < nearest[eject_b]:
+        return eject_a
+    return eject_b
+
+def scoreSwap(aux_distance, nearest, nearest_idx, eject, new_row):
+    """
+    Nearest neighbours of the selection once member eject is replaced by a candidate whose
+    distances to the current members are new_row. Only the members whose nearest neighbour
+    was eject need their row scanned again.
+    """
+    new_row = new_row.copy()
+    new_row[eject] = DIAGONAL
+    new_nearest = nearest.copy()
+    new_nearest_idx = nearest_idx.copy()
+
+    closer = (new_row < nearest) | ((new_row == nearest) & (eject < nearest_idx))
+    new_nearest[closer] = new_row[closer]
+    new_nearest_idx[closer] = eject
+
+    for i in np.flatnonzero(nearest_idx == eject):
+        if i == eject:
+            continue
+        row = aux_distance[i].copy()
+        row[eject] = new_row[i]
+        new_nearest_idx[i] = row.argmin()
+        new_nearest[i] = row[new_nearest_idx[i]]
+
+    new_nearest_idx[eject] = new_row.argmin()
+    new_nearest[eject] = new_row[new_nearest_idx[eject]]
+    return new_nearest, new_nearest_idx
+
+def scoreCandidates(aux_distance, nearest, nearest_idx, eject, rows):
+    """
+    Min pairwise distance of the selection for each candidate replacing member eject.
+    rows holds the (M, k) distances from the M candidates to the current members.
+    """
+    no_candidate = np.full(len(nearest), DIAGONAL)
+    retained_nearest, _ = scoreSwap(aux_distance, nearest, nearest_idx, eject, no_candidate)
+    rows = rows.copy()
+    rows[:, eject] = DIAGONAL
+    return np.minimum(rows.min(axis=1), retained_nearest.min())
+
+def applySwap(aux_distance, eject, new_row):
+    """
+    Replace row and column eject of the distance matrix in place.
+    """
+    aux_distance[eject, :] = new_row
+    aux_distance[:, eject] = new_row
+    aux_distance[eject, eject] = DIAGONAL
+
+def saveCheckpoint(path, indexes, min_distance, step, history, nb_items, candidates_per_step):
+    """
+    Write the search state after step to path atomically, through a temporary file.
+    """
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    with open(f"{path}.tmp", 'wb') as f:
+        np.savez(
+            f, indexes=indexes, min_distance=min_distance, step=step,
+            history=np.array(history, dtype=np.float64).reshape(-1, 4),
+            nb_items=nb_items, candidates_per_step=candidates_per_step,
+            rng_name=name, rng_keys=keys, rng_pos=pos, rng_has_gauss=has_gauss, rng_cached_gaussian=cached_gaussian)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(f"{path}.tmp", path)
+
+def loadCheckpoint(path, nb_items, k, candidates_per_step):
+    """
+    Search state saved at path, or None if missing or saved by a search over other items.
+    """
+    if not os.path.exists(path):
+        return None
+    saved = np.load(path)
+    if (int(saved['nb_items']), len(saved['indexes']), int(saved['candidates_per_step'])) != (nb_items, k, candidates_per_step):
+        print(f"Checkpoint at {path} is from another search, ignoring it")
+        return None
+    return {
+        'indexes': saved['indexes'],
+        'step': int(saved['step']),
+        'history': [tuple(h) for h in saved['history']],
+        'rng_state': (str(saved['rng_name']), saved['rng_keys'], int(saved['rng_pos']),
+                      int(saved['rng_has_gauss']), float(saved['rng_cached_gaussian'])),
+    }
+
+def drawCandidates(nb_items, nb_candidates):
+    """
+    Random distinct items. A single candidate is drawn as it always was, so that the searches of
+    existing seeds reproduce; several are drawn with replacement, without the permutation of all
+    items that choice without replacement costs, and repeats are dropped.
+    """
+    if nb_candidates == 1:
+        return np.random.choice(nb_items, size=1, replace=False)
+    candidates = np.random.randint(nb_items, size=nb_candidates)
+    _, first = np.unique(candidates, return_index=True)
+    return candidates[np.sort(first)]
+
+def swapSearch(getFeatures, nb_items, indexes, nbsteps, candidates_per_step=1, progress=False, verbose=False,
+               checkpoint=None, resume=False, checkpoint_seconds=DEFAULTCHECKPOINTSECONDS):
+    """
+    Random single-swap hill climbing on the min pairwise distance of a selection.
+    getFeatures maps an array of item indexes to their (n, d) features. The distance matrix of
+    the selection and the nearest neighbour of each member are kept between steps, so scoring
+    candidates costs one batched feature lookup and an (M, k) block of distances.
+    Each step draws up to candidates_per_step distinct candidates and tries the best one.
+    With a checkpoint path the state is saved there every checkpoint_seconds and at the end,
+    with resume the search continues from it instead of from indexes.
+    Returns the final indexes and min distance.
+    """
+    candidates_per_step = min(candidates_per_step, nb_items)
+    indexes = np.array(indexes)
+    first_step = -1
+    history = []
+    if checkpoint is not None and resume:
+        state = loadCheckpoint(checkpoint, nb_items, len(indexes), candidates_per_step)
+        if state is None:
+            print(f"No checkpoint to resume from at {checkpoint}, starting a new search")
+        else:
+            indexes, first_step, history = state['indexes'], state['step'] + 1, state['history']
+            np.random.set_state(state['rng_state'])
+            print(f"Resuming from step {first_step} of checkpoint {checkpoint}")
+    features = np.asarray(getFeatures(indexes), dtype=np.float64)
+    aux_distance = auxDistanceMatrix(features)
+    nearest, nearest_idx = nearestNeighbours(aux_distance)
+    min_distance = nearest.min()
+    print(f"Current indexes are {indexes.tolist()}")
+    print(f"Current min distance is {min_distance}")
+    last_checkpoint = time.time()
+
+    steps = range(first_step, nbsteps)
+    if progress:
+        from tqdm import tqdm
+        steps = tqdm(steps)
+
+    for step in steps:
+        if verbose:
+            print(f"------------------------- STEP {step}")
+        eject = chooseEject(nearest, nearest_idx)
+
+        new_cadidates = drawCandidates(nb_items, candidates_per_step)
+        with span('search features'):
+            new_features = np.asarray(getFeatures(new_cadidates), dtype=np.float64)
+        with span('search scoring'):
+            new_rows = distance_matrix(x=new_features, y=features)
+            new_min_distances = scoreCandidates(aux_distance, nearest, nearest_idx, eject, new_rows)
+        best = int(new_min_distances.argmax())
+        new_min_distance = new_min_distances[best]
+        count('search steps')
+        count('search candidates', len(new_cadidates))
+
+        if new_min_distance > min_distance:
+            count('search accepted')
+            new_row = new_rows[best]
+            nearest, nearest_idx = scoreSwap(aux_distance, nearest, nearest_idx, eject, new_row)
+            indexes[eject] = new_cadidates[best]
+            features[eject] = new_features[best]
+            applySwap(aux_distance, eject, new_row)
+            min_distance = new_min_distance
+            history.append((step, eject, indexes[eject], min_distance))
+            print(f"New min distance found at step {step}")
+            print(f"Updating indexes to new ones. New min distance is {min_distance}")
+
+        if checkpoint is not None and time.time() - last_checkpoint >= checkpoint_seconds:
+            with span('search checkpoints'):
+                saveCheckpoint(checkpoint, indexes, min_distance, step, history, nb_items, candidates_per_step)
+            last_checkpoint = time.time()
+
+    if checkpoint is not None and len(steps):
+        saveCheckpoint(checkpoint, indexes, min_distance, step, history, nb_items, candidates_per_step)
+        print(f"Search checkpoint saved at {checkpoint}")
+    return indexes, min_distance
+
+def minDistance(features):
+    return auxDistanceMatrix(features).min()
+
+def farthestPointInit(features, k, first=None):
+    """
+    Greedy farthest-point (Gonzalez) selection of k items in O(N k).
+    Each new item is the one farthest from the items already selected, found with a running
+    array of the distance from every item to the selection. The first item is drawn at random
+    unless given. float16 features are upcast block by block.
+    """
+    features = np.asarray(features)
+    blocks = [slice(b, b + FEATUREBLOCKSIZE) for b in range(0, len(features), FEATUREBLOCKSIZE)]
+    upcast = lambda rows: np.asarray(rows, dtype=np.float32) if features.dtype == np.float16 else rows
+    norms = np.concatenate(
+        [np.einsum('ij,ij->i', upcast(features[b]), upcast(features[b]), dtype=np.float64) for b in blocks] or [np.zeros(0)])
+    if first is None:
+        first = np.random.randint(len(features))
+
+    def squaredDistancesTo(i):
+        target = upcast(features[i])
+        dots = np.concatenate([upcast(features[b]) @ target for b in blocks] or [np.zeros(0)])
+        return norms + norms[i] - 2 * dots.astype(np.float64)
+
+    indexes = [int(first)]
+    min_distances = squaredDistancesTo(first)
+    for _ in range(k - 1):
+        farthest = int(min_distances.argmax())
+        indexes.append(farthest)
+        np.minimum(min_distances, squaredDistancesTo(farthest), out=min_distances)
+    return np.array(indexes)
+
+def exactMaxMin(distances, k, lower_bound_indexes=None, max_nodes=1000000):
+    """
+    Max-min dispersion of k items by branch and bound on a full (N, N) distance matrix, for small N.
+    Only selections strictly better than lower_bound_indexes, e.g. a heuristic result, are explored:
+    a candidate is dropped as soon as it is closer than the best min distance to an item already
+    selected. Returns the indexes, their min distance and whether the result is proven optimal,
+    which is not the case when the search stopped after max_nodes nodes.
+    """
+    distances = np.asarray(distances, dtype=np.float64)
+    nb_items = len(distances)
+    best_indexes = None
+    best = -np.inf
+    if lower_bound_indexes is not None:
+        best_indexes = np.array(lower_bound_indexes)
+        best = (distances[np.ix_(best_indexes, best_indexes)] + DIAGONAL * np.eye(k)).min()
+    nodes = 0
+
+    def search(selected, candidates, current_min):
+        nonlocal best, best_indexes, nodes
+        if len(selected) == k:
+            best, best_indexes = current_min, np.array(selected)
+            return
+        for pos, c in enumerate(candidates):
+            if nodes >= max_nodes or len(selected) + len(candidates) - pos < k:
+                return
+            nodes += 1
+            new_min = min(current_min, distances[c, selected].min()) if selected else np.inf
+            if new_min <= best:
+                continue
+            rest = candidates[pos + 1:]
+            search(selected + [c], rest[distances[c, rest] > best], new_min)
+
+    search([], np.arange(nb_items), np.inf)
+    record('exact nodes', nodes)
+    return best_indexes, best, nodes < max_nodes
+
+def initRestartWorker(features_spec):
+    global restart_shm, restart_features
+    restart_shm, restart_features = fromSharedMemory(features_spec)
+
+def runRestart(seed, k, nbsteps, candidates_per_step, init):
+    np.random.seed(seed)
+    start = time.time()
+    features = restart_features
+    with contextlib.redirect_stdout(io.StringIO()):
+        if init == 'greedy':
+            indexes = farthestPointInit(features, k)
+        else:
+            indexes = np.random.choice(len(features), size=k, replace=False)
+        # same steps as pairsFind: no swap search without steps
+        if nbsteps > 0:
+            indexes, min_distance = swapSearch(
+                lambda idx: features[idx], len(features), indexes, nbsteps,
+                candidates_per_step=candidates_per_step)
+        else:
+            min_distance = minDistance(features[indexes])
+    return seed, indexes, min_distance, time.time() - start
+
+def parallelRestarts(features, k, seeds, nbsteps, candidates_per_step=1, init='random', workers=None):
+    """
+    One independent search per seed, run by a process pool that reads the (N, d) features from
+    shared memory. A restart with a given seed selects the same items as a single run seeded with it,
+    without the exact solver, which restarts do not run.
+    Returns the best seed, its indexes and min distance, and a (seed, min distance, seconds) summary.
+    """
+    shm, spec = toSharedMemory(np.asarray(features))
+    try:
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers, initializer=initRestartWorker, initargs=(spec,)) as executor:
+            futures = [executor.submit(runRestart, seed, k, nbsteps, candidates_per_step, init) for seed in seeds]
+            results = [f.result() for f in futures]
+    finally:
+        shm.close()
+        shm.unlink()
+
+    best_seed, best_indexes, best_distance, _ = max(results, key=lambda r: r[2])
+    summary = [(seed, min_distance, elapsed) for seed, _, min_distance, elapsed in results]
+    return best_seed, best_indexes, best_distance, summary
+
+def saveRestartSummary(summary, path):
+    """
+    Print the summary of parallelRestarts as a table and save it as csv.
+    """
+    print(f"{'seed':>10}{'min distance':>16}{'seconds':>12}")
+    for seed, min_distance, elapsed in summary:
+        print(f"{seed:>10}{min_distance:>16.6f}{elapsed:>12.3f}")
+    with open(path, 'w') as f:
+        f.write('seed,min_distance,seconds\n')
+        f.writelines(f"{seed},{min_distance},{elapsed}\n" for seed, min_distance, elapsed in summary)
+    print(f"Restarts summary saved at {path}")
@@ -1,7 +1,5 @@
 # https://gist.github.com/duhaime/211365edaddf7ff89c0a36d9f3f7956c
 
-import ipdb
-
 import os
 import time
 import logging
@@ -13,11 +11,13 @@ from glob import glob
 from tqdm import tqdm
 from argparse import ArgumentParser
 
-import cv2
 import numpy as np
 from scipy.stats import wasserstein_distance
-import seaborn as sns
-import matplotlib.pyplot as plt
+
+from videoFrames import frameName, probeVideo, streamFrames
+from frameHashes import dHash, pruneNearDuplicates, savePruning
+from runMetrics import metricsFile, saveMetrics, span, startProfiling
+from figureWorker import FigureWorker, saveHeatmap
 
 warnings.filterwarnings('ignore')
 
@@ -29,6 +29,7 @@ def get_img(path, norm_size=False, norm_exposure=False):
   '''
   Prepare an image for image processing tasks
   '''
+  import cv2
   # flatten returns a 2d grayscale array
   img = cv2.imread(path)
   # make image grayscale
@@ -45,12 +46,75 @@ def get_histogram(img):
   the percent of the pixels in the image with the given darkness level.
   The histogram's values sum to 1.
   '''
+  import cv2
   bgr_planes = cv2.split(img)
   histSize = 256
   accumulate = False
   histg = cv2.calcHist(bgr_planes, [0], None, [histSize], (0, histSize), accumulate=False)
   return histg.flatten()
 
+def load_frame(path, downsample=1):
+  '''
+  Decode an image once into its grayscale array, subsampled by downsample, and the histogram
+  of the full image
+  '''
+  img = get_img(path)
+  return img[::downsample, ::downsample], get_histogram(img)
+
+def load_frames(paths, downsample=1):
+  '''
+  Decode all images in parallel, each one once, into one preallocated array.
+  Returns the (N, H, W) uint8 array of grayscale images subsampled by downsample and the
+  (N, 256) array of histograms of the full images
+  '''
+  if not paths:
+    return np.zeros((0, 0, 0), dtype=np.uint8), np.zeros((0, 256), dtype=np.float32)
+  first, hist = load_frame(paths[0], downsample)
+  imgs = np.empty((len(paths),) + first.shape, dtype=np.uint8)
+  hists = np.empty((len(paths), len(hist)), dtype=np.float32)
+  imgs[0], hists[0] = first, hist
+
+  def decode(n):
+    img, hist = load_frame(paths[n], downsample)
+    if img.shape != first.shape:
+      raise ValueError(f"{paths[n]} is {img.shape} after downsampling, {paths[0]} is {first.shape}")
+    imgs[n], hists[n] = img, hist
+
+  with concurrent.futures.ThreadPoolExecutor() as executor:
+    list(executor.map(decode, range(1, len(paths))))
+  return imgs, hists
+
+def stream_frames(video_path, limit=None, downsample=1):
+  '''
+  Grayscale arrays and histograms of the first limit frames of a video, read from an ffmpeg
+  pipe without writing images. Grayscale is ffmpeg's conversion, not cv2's.
+  Frames are kept subsampled by downsample in an array sized from the probed number of frames.
+  Returns the frame indexes, the (N, H, W) uint8 array and the (N, 256) array of histograms
+  '''
+  info = probeVideo(video_path)
+  capacity = max(1, info['nb_frames'] if limit is None else min(limit, info['nb_frames'] or limit))
+  shape = (len(range(0, info['height'], downsample)), len(range(0, info['width'], downsample)))
+  imgs = np.empty((capacity,) + shape, dtype=np.uint8)
+  hists = np.empty((capacity, 256), dtype=np.float32)
+  nb = 0
+  for index, _, img in streamFrames(video_path, pix_fmt='gray', info=info):
+    if limit is not None and index >= limit:
+      break
+    if nb == len(imgs):
+      # more frames than packets probed
+      imgs = np.concatenate([imgs, np.empty_like(imgs)])
+      hists = np.concatenate([hists, np.empty_like(hists)])
+    imgs[nb] = img[::downsample, ::downsample]
+    hists[nb] = get_histogram(img)
+    nb += 1
+  return list(range(nb)), imgs[:nb], hists[:nb]
+
+def histograms_earth_movers_distance(hist_a, hist_b):
+  return wasserstein_distance(hist_a, hist_b)
+
+def arrays_l0(img_a, img_b):
+  return np.sum(np.absolute(img_a - img_b)) / (height*width)
+
 def earth_movers_distance(path_a, path_b):
   '''
   Measure the Earth Mover's distance between two images
@@ -59,7 +123,7 @@ def earth_movers_distance(path_a, path_b):
   img_b = get_img(path_b, norm_exposure=False)
   hist_a = get_histogram(img_a)
   hist_b = get_histogram(img_b)
-  return wasserstein_distance(hist_a, hist_b)
+  return histograms_earth_movers_distance(hist_a, hist_b)
 
 
 def l0(path_a, path_b):
@@ -68,7 +132,80 @@ def l0(path_a, path_b):
   '''
   img_a = get_img(path_a, norm_exposure=True)
   img_b = get_img(path_b, norm_exposure=True)
-  return np.sum(np.absolute(img_a - img_b)) / (height*width)
+  return arrays_l0(img_a, img_b)
+
+def upper_to_symmetric(distances):
+  '''
+  Symmetric matrix from the pairs i < j, as filled by the per-pair loop
+  '''
+  upper = np.triu(distances, k=1)
+  return upper + upper.T
+
+def pairwise_earth_movers_distances(hists, tile_bytes=2**26):
+  '''
+  earth_movers_distance for all pairs of histograms, as an (N, N) matrix.
+  wasserstein_distance(hist_a, hist_b) is the mean absolute difference of the sorted values,
+  so each histogram is sorted once and the pairs i <= j are computed on tiles whose
+  differences fit in tile_bytes.
+  '''
+  hists = np.asarray(hists, dtype=np.float64)
+  sorted_hists = np.sort(hists, axis=1)
+  nb, nb_bins = sorted_hists.shape
+  tile = max(1, int(np.sqrt(tile_bytes / max(nb_bins * sorted_hists.itemsize, 1))))
+  distances = np.zeros((nb, nb))
+  for i in range(0, nb, tile):
+    for j in range(i, nb, tile):
+      diff = sorted_hists[i:i + tile, None, :] - sorted_hists[None, j:j + tile, :]
+      np.abs(diff, out=diff)
+      distances[i:i + tile, j:j + tile] = diff.mean(axis=2)
+  return upper_to_symmetric(distances)
+
+def pairwise_l0(imgs, downsample=1, metric='l0', tile_bytes=2**26, decoded_downsample=1):
+  '''
+  Pixel distances for all pairs of grayscale images, as an (N, N) matrix, computed on tiles of
+  flattened images that fit in tile_bytes.
+  metric 'l0' is the l0 measure, with its uint8 wraparound, of the first image of a pair in
+  the list against the second, 'l1' is the mean absolute pixel difference times 255.
+  Images are subsampled by downsample in both directions, the result keeps the full size scale.
+  decoded_downsample is the subsampling already applied when the images were decoded.
+  '''
+  if isinstance(imgs, np.ndarray) and downsample == 1:
+    flat = imgs.reshape(len(imgs), -1)
+  else:
+    shape = imgs[0][::downsample, ::downsample].shape if len(imgs) else (0,)
+    flat = np.empty((len(imgs), int(np.prod(shape))), dtype=np.uint8)
+    for n, img in enumerate(imgs):
+      flat[n] = img[::downsample, ::downsample].ravel()
+  if metric == 'l1':
+    flat = flat.astype(np.int16)
+  nb, nb_pixels = flat.shape
+  tile = max(1, int(np.sqrt(tile_bytes / max(nb_pixels * flat.itemsize, 1))))
+  distances = np.zeros((nb, nb))
+  for i in range(0, nb, tile):
+    for j in range(i, nb, tile):
+      diff = flat[i:i + tile, None, :] - flat[None, j:j + tile, :]
+      if metric == 'l1':
+        diff = np.abs(diff)
+      distances[i:i + tile, j:j + tile] = diff.sum(axis=2, dtype=np.int64)
+  return upper_to_symmetric(distances) * (downsample * decoded_downsample)**2 / (height*width)
+
+def check_pairwise_engine(images, nb_check=6):
+  '''
+  Compare the matrix engine with the per-pair functions on the first nb_check images
+  '''
+  images = images[:nb_check]
+  imgs, hists = load_frames(images)
+  l0_distances = pairwise_l0(imgs)
+  emd_distances = pairwise_earth_movers_distances(hists)
+  l0_error = 0
+  emd_error = 0
+  for i, j in itertools.combinations(range(len(images)), 2):
+    l0_error = max(l0_error, abs(l0_distances[i, j] - l0(images[i], images[j])))
+    emd_error = max(emd_error, abs(emd_distances[i, j] - earth_movers_distance(images[i], images[j])))
+  print(f"Max difference with the per-pair functions on {len(images)} images: l0 {l0_error}, emd {emd_error}")
+  if not (l0_error < 1e-9 and emd_error < 1e-6):
+    raise RuntimeError("matrix engine disagrees with the per-pair functions")
+  return l0_error, emd_error
 
 def extract_all_frames(video_path, output_folder):
     """
@@ -97,10 +234,21 @@ if __name__ == "__main__":
     ap.add_argument(
         '--video', type=str, default="../ForLearning_2025.mp4")
     ap.add_argument('--limit', type=int, default=3)
+    ap.add_argument('--downsample', type=int, default=1)
+    ap.add_argument('--check', action='store_true')
+    ap.add_argument('--stream', action='store_true')
+    ap.add_argument('--dedup-threshold', type=int, default=None)
+    ap.add_argument('--profile', action='store_true')
 
     args = ap.parse_args()
     video_path = args.video
     limit = args.limit
+    downsample = args.downsample
+    check = args.check
+    stream = args.stream
+    dedup_threshold = args.dedup_threshold
+    profile = args.profile
+    profiler = startProfiling() if profile else None
 
     parent_folder, file_path = os.path.split(video_path)
     file_name, extention = file_path.split('.')
@@ -115,63 +263,86 @@ if __name__ == "__main__":
       filemode='w',
       level=logging.INFO)
 
-    logger.info(f"Extranting images from video {video_path} to folder {output_folder}")
-    extract_all_frames(video_path, output_folder_images)
+    if stream:
+        # frames come straight from ffmpeg, no image is written
+        start = time.time()
+        with span('decode'):
+            order, imgs, hists = stream_frames(video_path, limit, downsample)
+        nb_images = len(imgs)
+        logger.info(f"Streaming {nb_images} frames from {video_path} took {time.time() - start} seconds.")
+        logger.info(f"Must compute {int(nb_images * (nb_images - 1) / 2)} distances.")
+    else:
+        logger.info(f"Extranting images from video {video_path} to folder {output_folder}")
+        with span('extraction'):
+            extract_all_frames(video_path, output_folder_images)
 
-    images = glob(os.path.join(output_folder_images, '*'))[:limit]
-    nb_images = len(images)
-    logger.info(f"Found {nb_images} images at {output_folder}")
-    logger.info(f"Must compute {int(nb_images * (nb_images - 1) / 2)} distances.")
+        images = sorted(glob(os.path.join(output_folder_images, '*')))[:limit]
+        nb_images = len(images)
+        logger.info(f"Found {nb_images} images at {output_folder}")
+        logger.info(f"Must compute {int(nb_images * (nb_images - 1) / 2)} distances.")
 
-    pairs = [p for p in itertools.combinations(images, 2)]
+        if check:
+            l0_error, emd_error = check_pairwise_engine(images)
+            logger.info(f"Matrix engine check: max l0 difference {l0_error}, max emd difference {emd_error}")
+
+        # decode every image once, all distances read from this cache
+        start = time.time()
+        with span('decode'):
+            imgs, hists = load_frames(images, downsample)
+        order = [int(os.path.split(image)[1].split(".png")[0]) - 1 for image in images]
+        logger.info(f"Decoding {nb_images} images took {time.time() - start} seconds.")
+
+    if dedup_threshold is not None:
+        # only compare frames that are not near duplicates of an earlier one, hashed at the decoded size
+        start = time.time()
+        with span('dedup'):
+            hashes = [dHash(img) for img in imgs]
+            kept, representatives = pruneNearDuplicates(hashes, dedup_threshold)
+        savePruning(
+          os.path.join(output_folder, f"{file_name}_kept_frames_DEDUP_{dedup_threshold}.json"),
+          [f"{frameName(n)}.png" for n in order], hashes, kept, representatives, dedup_threshold)
+        order = [order[k] for k in kept]
+        imgs = imgs[kept]
+        hists = hists[kept]
+        nb_images = len(imgs)
+        logger.info(f"Pruning near duplicates took {time.time() - start} seconds, kept {nb_images} frames.")
+        logger.info(f"Must compute {int(nb_images * (nb_images - 1) / 2)} distances.")
 
-    # launch multiple threads computing distances and collect results
     start = time.time()
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        l0_futures = [executor.submit(l0, p[0], p[1]) for p in pairs]
-        l0_results = [f.result() for f in l0_futures]
+    with span('l0 distances'):
+        l0_distances = pairwise_l0(imgs, decoded_downsample=downsample)
     logger.info(f"Calculing l0 distances took {time.time() - start} seconds.")
 
     start = time.time()
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        emd_futures = [executor.submit(earth_movers_distance, p[0], p[1]) for p in pairs]
-        emd_results = [f.result() for f in emd_futures]
+    with span('emd distances'):
+        emd_distances = pairwise_earth_movers_distances(hists)
     logger.info(f"Calculing earth movers distances took {time.time() - start} seconds.")
 
-    # store results in a matrix
-    l0_distances = np.zeros((nb_images, nb_images))
-    emd_distances = np.zeros((nb_images, nb_images))
-    for n, p in enumerate(pairs):
-        i = int(os.path.split(p[0])[1].split(".png")[0]) - 1
-        j = int(os.path.split(p[1])[1].split(".png")[0]) - 1
-        l0_distances[i, j] = l0_results[n]
-        emd_distances[i, j] = emd_results[n]
+    # store results in a matrix ordered by frame number
+    by_frame = np.argsort(order)
+    l0_distances = l0_distances[np.ix_(by_frame, by_frame)]
+    emd_distances = emd_distances[np.ix_(by_frame, by_frame)]
 
-    l0_distances = l0_distances + l0_distances.T
     l0_distances[np.diag_indices(nb_images)] = 1
-
-    emd_distances = emd_distances + emd_distances.T
     emd_distances[np.diag_indices(nb_images)] = 1
 
     # print(f"l0:\n{l0_distances}")
     # print(f"earth movers distance:\n{emd_distances}")
 
-    np.savetxt(
-      X=l0_distances,
-      fname=os.path.join(output_folder, f"{file_name}_l0.csv"),
-      delimiter=",")
-    np.savetxt(
-      X=emd_distances,
-      fname=os.path.join(output_folder, f"{file_name}_emd.csv"),
-      delimiter=",")
-
-    fig, ax = plt.subplots(figsize=(10,10))
-    annot = True if nb_images <= 10 else False
-    heatmap = sns.heatmap(emd_distances, annot=annot, cmap='YlGnBu', linewidths=0.001, ax=ax)
-    heatmap.get_figure().savefig(os.path.join(output_folder, f"{file_name}_emd.png"))
-
-    fig, ax = plt.subplots(figsize=(10,10))
-    annot = True if nb_images <= 10 else False
-    heatmap = sns.heatmap(l0_distances, annot=annot, cmap='crest', linewidths=0.001, ax=ax)
-    heatmap.get_figure().savefig(os.path.join(output_folder, f"{file_name}_l0.png"))
+    with span('export'):
+        np.savetxt(
+          X=l0_distances,
+          fname=os.path.join(output_folder, f"{file_name}_l0.csv"),
+          delimiter=",")
+        np.savetxt(
+          X=emd_distances,
+          fname=os.path.join(output_folder, f"{file_name}_emd.csv"),
+          delimiter=",")
+
+    # heatmaps are drawn in the background once the matrices are saved
+    figures = FigureWorker()
+    figures.submit(saveHeatmap, emd_distances, os.path.join(output_folder, f"{file_name}_emd.png"), cmap='YlGnBu')
+    figures.submit(saveHeatmap, l0_distances, os.path.join(output_folder, f"{file_name}_l0.png"), cmap='crest')
+    saveMetrics(metricsFile(output_folder, 'naiveImageSimilarity'), vars(args), profiler)
+    figures.close()
 
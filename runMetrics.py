@@ -0,0 +1,103 @@
+"""
+Run instrumentation shared by the scripts.
+
+Stages are timed with `with span(name):`, events are counted with count(name), and saveMetrics
+writes them with the peak memory of the process as a json file at the end of a run. With a
+profiler from startProfiling the cProfile stats are saved next to it, as .prof and as text.
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import pstats
+import cProfile
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+START = time.time()
+SPANS = {}
+COUNTERS = {}
+VALUES = {}
+
+
+@contextmanager
+def span(name):
+    """
+    Time the enclosed block. Repeated spans of the same name add up.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        calls, total, longest = SPANS.get(name, (0, 0., 0.))
+        SPANS[name] = (calls + 1, total + elapsed, max(longest, elapsed))
+
+def count(name, n=1):
+    COUNTERS[name] = COUNTERS.get(name, 0) + n
+
+def record(name, value):
+    VALUES[name] = value
+
+def peakRss():
+    """
+    Peak resident memory of the process and of its finished children in MB, None if unknown.
+    """
+    if resource is None:
+        return None
+    # kilobytes on linux, bytes on macos
+    unit = 1e6 if sys.platform == 'darwin' else 1e3
+    return {
+        'self': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / unit,
+        'children': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / unit,
+    }
+
+def metrics():
+    steps = COUNTERS.get('search steps', 0)
+    return {
+        'seconds': time.time() - START,
+        'peak_rss_mb': peakRss(),
+        'spans': {
+            name: {'calls': calls, 'seconds': total, 'longest': longest}
+            for name, (calls, total, longest) in SPANS.items()},
+        'counters': dict(COUNTERS),
+        'acceptance_rate': COUNTERS.get('search accepted', 0) / steps if steps else None,
+        'values': dict(VALUES),
+    }
+
+def startProfiling():
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+def metricsFile(folder, script):
+    return os.path.join(folder, f"metrics_{script}_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.json")
+
+def saveMetrics(path, parameters=None, profiler=None):
+    """
+    Write the metrics of the run, and the profile if a profiler is running, then print the spans.
+    """
+    run = {'parameters': parameters, **metrics()}
+    with open(path, 'w') as f:
+        json.dump(run, f, indent=4, default=str)
+    print(f"{'span':<30}{'calls':>8}{'seconds':>12}")
+    for name, s in sorted(run['spans'].items(), key=lambda item: -item[1]['seconds']):
+        print(f"{name:<30}{s['calls']:>8}{s['seconds']:>12.3f}")
+    print(f"Peak memory {run['peak_rss_mb']} MB, metrics saved at {path}")
+
+    if profiler is not None:
+        profiler.disable()
+        base = path[:-len('.json')] if path.endswith('.json') else path
+        profiler.dump_stats(f"{base}.prof")
+        text = io.StringIO()
+        pstats.Stats(profiler, stream=text).sort_stats('cumulative').print_stats(40)
+        with open(f"{base}_profile.txt", 'w') as f:
+            f.write(text.getvalue())
+        print(f"Profile saved at {base}.prof and {base}_profile.txt")
@@ -0,0 +1,70 @@
+"""
+Export of a selection: files placed without copying their bytes when possible, and a manifest.
+
+A selected file is reflinked to its source (copy-on-write clone, on filesystems supporting the
+Linux FICLONE ioctl), else copied. Files are placed by a pool of threads, none of them goes
+through a shell. Hardlinks are opt-in: a hardlinked file shares its inode with the source, and
+tools rewriting files in place, like ffmpeg re-extracting frames, would change the export too.
+"""
+
+import os
+import json
+import shutil
+import concurrent.futures
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# linux/fs.h _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+
+def reflink(source, destination):
+    with open(source, 'rb') as src, open(destination, 'wb') as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+def placeFile(source, destination, hardlink=False):
+    """
+    Hardlink if asked, else reflink, else copy source to destination, replacing it.
+    Returns the method used.
+    """
+    if os.path.lexists(destination):
+        os.remove(destination)
+    if hardlink:
+        try:
+            os.link(source, destination)
+            return 'hardlink'
+        except OSError:
+            pass
+    if fcntl is not None:
+        try:
+            reflink(source, destination)
+            return 'reflink'
+        except OSError:
+            if os.path.exists(destination):
+                os.remove(destination)
+    shutil.copyfile(source, destination)
+    return 'copy'
+
+def placeFiles(sources, destinations, workers=None, hardlink=False):
+    """
+    placeFile for every pair, by a pool of threads. Returns the methods used, in order.
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(lambda pair: placeFile(*pair, hardlink), zip(sources, destinations)))
+
+def saveManifest(jsonfile, script, parameters, selection, **info):
+    """
+    Selection entries in their final order, with the parameters of the run and any other info.
+    """
+    manifest = {
+        'script': script,
+        'parameters': parameters,
+        **info,
+        'selection': selection,
+    }
+    with open(jsonfile, 'w') as f:
+        json.dump(manifest, f, indent=4, default=str)
+    print(f"Selection manifest saved at {jsonfile}")
@@ -0,0 +1,31 @@
+"""
+Numpy arrays handed read-only to worker processes through shared memory instead of pickling.
+"""
+
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+def toSharedMemory(array):
+    """
+    Copy array into a new shared memory block.
+    Returns the block, to be closed and unlinked by the owner, and a picklable spec for the workers.
+    """
+    array = np.ascontiguousarray(array)
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    shared = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+    shared[...] = array
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+def fromSharedMemory(spec):
+    """
+    Attach to a block created by toSharedMemory. The block must stay referenced while the array is used.
+    """
+    name, shape, dtype = spec
+    try:
+        shm = shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # python < 3.13, pool workers share the resource tracker of the owner which unlinks the block
+        shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
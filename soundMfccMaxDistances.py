@@ -2,28 +2,34 @@ import os
 import json
 import time
 import logging
-import itertools
 import subprocess
 import concurrent.futures
 from itertools import combinations
 from glob import glob
-from copy import deepcopy
 from argparse import ArgumentParser
 
 import librosa
 import soundfile as sf
 import numpy as np
+from scipy.fft import dct
 from scipy.spatial import distance_matrix
 
-import seaborn as sns
-import matplotlib.pyplot as plt
-
-import ipdb
 import warnings
 warnings.filterwarnings('ignore')
 
+from maxMinSearch import auxDistanceMatrix, minDistance, parallelRestarts, saveRestartSummary, swapSearch
+from sharedArrays import fromSharedMemory, toSharedMemory
+from runMetrics import metricsFile, record, saveMetrics, span, startProfiling
+from figureWorker import FigureWorker, pyplot, saveHeatmap, saveSpectrograms
+from selectionExport import saveManifest
+
 DEFAULTNBFINALCOMBS = 10
+DEFAULTNBFLUTES = 6
 DEFAULTMAXNBSTEPS = 500
+DEFAULTCANDIDATESPERSTEP = 1
+DEFAULTSTORECHUNK = 4096
+DEFAULTWORKERS = 1
+DEFAULTRESTARTS = 1
 DEFAULTAUDIOFOLDER = f"/home/jimena/work/dev/ARTEX/renamed"
 DEFAULTRESULTSFOLDER = f"/home/jimena/work/dev/ARTEX/results/flutes"
 
@@ -31,25 +37,69 @@ DEFAULTSEED = 1334
 
 SAMPLINGRATE = 44100
 
+# librosa.feature.melspectrogram / mfcc defaults used by compute_mfcc
+N_FFT = 2048
+HOP_LENGTH = 512
+N_MELS = 128
+FMAX = 8000
+N_MFCC = 13
+TOP_DB = 80.0
+
 # from joblib import delayed, Parallel
 # from joblib import dump, load
 
 
-dictParms = {
-    '0': '0.05 0',
-    '1': '0.05 0.25',
-    '2': '0.05 0.5',
-    '3': '0.05 0.75',
-    '4': '0.05 0.99',
-    '5': '0.1 0.99',
-    '6': '0.1 0.75',
-    '7': '0.1 0.5',
-    '8': '0.1 0.25',
-    '9': '0.1 0',
-}
+# synthesis parameters of each sample index
+SAMPLEPARAMETERS = [
+    '0.05 0',
+    '0.05 0.25',
+    '0.05 0.5',
+    '0.05 0.75',
+    '0.05 0.99',
+    '0.1 0.99',
+    '0.1 0.75',
+    '0.1 0.5',
+    '0.1 0.25',
+    '0.1 0',
+]
 
 def combinationsToParams(combination):
-    return ' '.join([dictParms[c] for c in combination])
+    return ' '.join([SAMPLEPARAMETERS[s] for s in combination])
+
+class CombinationSpace:
+    """
+    All the combinations of one sample per flute, indexed without materializing them.
+    An index is a mixed-radix number with one digit per flute, the first flute being the most
+    significant one, which is the order of itertools.product over the samples of each flute.
+    """
+
+    def __init__(self, nb_samples):
+        # number of samples of each flute, the radix of its digit
+        self.nb_samples = np.array(nb_samples, dtype=np.int64)
+        self.nb_flutes = len(self.nb_samples)
+        # place value of each digit
+        self.strides = np.ones(self.nb_flutes, dtype=np.int64)
+        for k in range(self.nb_flutes - 2, -1, -1):
+            self.strides[k] = self.strides[k + 1] * self.nb_samples[k + 1]
+
+    def __len__(self):
+        return int(np.prod(self.nb_samples))
+
+    def toSamples(self, index):
+        return tuple(int(s) for s in (index // self.strides) % self.nb_samples)
+
+    def toIndex(self, samples):
+        return int(np.dot(samples, self.strides))
+
+    def decode(self, indexes):
+        """
+        Sample indexes of each combination index, as an (n, nb flutes) int8 array.
+        """
+        indexes = np.asarray(indexes, dtype=np.int64)
+        return ((indexes[:, None] // self.strides) % self.nb_samples).astype(np.int8)
+
+    def encode(self, combs):
+        return np.asarray(combs, dtype=np.int64) @ self.strides
 
 def compute_mfcc(y, sr):
     S = librosa.feature.melspectrogram(y=y, sr=sr, n_mels=128, fmax=8000)
@@ -61,6 +111,8 @@ def compute_mfcc_from_path(path):
     return compute_mfcc(y, sr)
 
 def show(path):
+    import librosa.display
+    plt = pyplot(interactive=True)
     S, mfccs = compute_mfcc_from_path(path)
     fig, ax = plt.subplots(nrows=2, sharex=True)
     img = librosa.display.specshow(librosa.power_to_db(S, ref=np.max),
@@ -83,29 +135,108 @@ def loadAndMiddleCrop(path, seconds=1):
     y = y[init:end]
     return y[:seconds*sr]
 
+def loadSampleBank(flutes, seconds=1):
+    """
+    Decode every flute sample once and keep its middle crop in memory.
+    Returns a contiguous float32 array of shape (nb flutes, nb samples, seconds * sr).
+    """
+    nb_flutes = len(flutes)
+    nb_samples = max(len(paths) for paths in flutes.values())
+    bank = np.zeros((nb_flutes, nb_samples, seconds * SAMPLINGRATE), dtype=np.float32)
+    paths = [(k, n, path) for k in range(nb_flutes) for n, path in enumerate(flutes[f"flute {k}"])]
+    start = time.time()
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        futures = [executor.submit(loadAndMiddleCrop, path, seconds) for _, _, path in paths]
+        for (k, n, _), f in zip(paths, futures):
+            y = f.result()
+            bank[k, n, :len(y)] = y
+    print(f"Decoding {len(paths)} samples took {time.time() - start} seconds.")
+    print(f"Sample bank shape is {bank.shape} ({bank.nbytes / 1e6:.1f} MB)")
+    return bank
+
 def getMeanAudio(comb, savepath=None):
-    y0 = loadAndMiddleCrop(flutes["flute 0"][int(comb[0])])
-    y1 = loadAndMiddleCrop(flutes["flute 1"][int(comb[1])])
-    y2 = loadAndMiddleCrop(flutes["flute 2"][int(comb[2])])
-    y3 = loadAndMiddleCrop(flutes["flute 3"][int(comb[3])])
-    y4 = loadAndMiddleCrop(flutes["flute 4"][int(comb[4])])
-    y5 = loadAndMiddleCrop(flutes["flute 5"][int(comb[5])])
-    y = np.mean([y0, y1, y2, y3, y4, y5], axis=0)
+    y = bank[np.arange(len(comb)), comb].mean(axis=0)
     if savepath:
         sf.write(savepath, y, SAMPLINGRATE, 'PCM_24')
     return y
 
+def getMeanAudios(combs):
+    """
+    Mixes of an (n, nb flutes) array of sample indexes from the sample bank, as an (n, length) array.
+    """
+    combs = np.asarray(combs)
+    return bank[np.arange(combs.shape[1]), combs].mean(axis=1)
+
+def saveMeanAudios(mixes, paths):
+    """
+    Write the mixes as wav files, concurrently: libsndfile encodes outside the GIL.
+    """
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        list(executor.map(lambda yp: sf.write(yp[1], yp[0], SAMPLINGRATE, 'PCM_24'), zip(mixes, paths)))
+
 def getMeanDescriptors(comb):
     y = getMeanAudio(comb)
     S, mfcc = compute_mfcc(y, sr=44100)
     return S, mfcc
 
-def showSamplesDistanceMatrix(samples):
-    # launch multiple threads computing distances and collect results
+def getFeatureBases(sr=SAMPLINGRATE):
+    """
+    Mel filterbank and orthonormal DCT-II matrix applied by compute_mfcc.
+    The filterbank is zero above fmax, so it is cut to the frequency bins it uses.
+    """
+    mel_basis = librosa.filters.mel(sr=sr, n_fft=N_FFT, n_mels=N_MELS, fmax=FMAX)
+    nb_bins = np.flatnonzero(mel_basis.any(axis=0)).max() + 1
+    mel_basis = np.ascontiguousarray(mel_basis[:, :nb_bins])
+    dct_basis = dct(np.eye(N_MELS), type=2, norm='ortho', axis=0)[:N_MFCC].astype(np.float32)
+    return mel_basis, dct_basis
+
+def computeSampleStfts(bank, nb_bins):
+    """
+    Complex STFT of every crop of the sample bank, computed once and kept up to nb_bins.
+    The STFT is linear, so the STFT of a mean audio is the mean of these spectra.
+    Returns a complex64 array of shape (nb flutes, nb samples, nb_bins, frames).
+    """
     start = time.time()
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        futures = [executor.submit(compute_mfcc, s) for s in samples]
-        results = [f.result() for f in futures]
+    stfts = librosa.stft(bank, n_fft=N_FFT, hop_length=HOP_LENGTH, center=True, pad_mode='constant')
+    stfts = np.ascontiguousarray(stfts[..., :nb_bins, :])
+    print(f"Calculing {bank.shape[0] * bank.shape[1]} sample STFTs took {time.time() - start} seconds.")
+    return stfts
+
+def computeFeaturesFromStfts(combs, stfts, mel_basis, dct_basis, batch_size=64):
+    """
+    Batched equivalent of getMeanDescriptors working on precomputed sample STFTs.
+    combs is an (n, nb flutes) integer array of sample indexes. For each batch the mean
+    spectrum of every combination is summed from stfts, then the mel filterbank,
+    power_to_db and the DCT are applied to the whole batch with array operations.
+    The mfccs match compute_mfcc on the mixed audio within 1e-5 relative to their largest
+    magnitude (float32 rounding), which is about 1e3 for near-silent mixes.
+    Returns mel spectrograms (n, n_mels, frames) and mfccs (n, n_mfcc, frames).
+    """
+    combs = np.asarray(combs)
+    nb_flutes = combs.shape[1]
+    nb_frames = stfts.shape[-1]
+    mel = np.empty((len(combs), N_MELS, nb_frames), dtype=np.float32)
+    mfcc = np.empty((len(combs), N_MFCC, nb_frames), dtype=np.float32)
+    for start in range(0, len(combs), batch_size):
+        batch = combs[start:start + batch_size]
+        spectrum = stfts[0, batch[:, 0]]
+        for k in range(1, nb_flutes):
+            spectrum += stfts[k, batch[:, k]]
+        power = (spectrum.real ** 2 + spectrum.imag ** 2) / nb_flutes ** 2
+        S = np.matmul(mel_basis, power)
+        # librosa.power_to_db with ref=1.0, amin=1e-10 and top_db per spectrogram
+        S_db = 10.0 * np.log10(np.maximum(S, 1e-10))
+        S_db = np.maximum(S_db, S_db.max(axis=(1, 2), keepdims=True) - TOP_DB)
+        mel[start:start + batch_size] = S
+        mfcc[start:start + batch_size] = np.matmul(dct_basis, S_db)
+    return mel, mfcc
+
+def showSamplesDistanceMatrix(samples, workers=None):
+    # launch multiple processes computing features and collect results
+    start = time.time()
+    chunksize = max(1, len(samples) // (4 * (workers or os.cpu_count())))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(compute_mfcc_from_path, samples, chunksize=chunksize))
     print(f"Calculing mffc fetures took {time.time() - start} seconds.")
 
     mel_spectrograms = [r[0].mean(axis=1) for r in results]
@@ -114,26 +245,12 @@ def showSamplesDistanceMatrix(samples):
     distances_mel = distance_matrix(mel_spectrograms, mel_spectrograms, p=2)
     distances_mfcc = distance_matrix(mfccs, mfccs, p=2)
 
-    fig, ax = plt.subplots(figsize=(10,10))
-    annot = True if nb_samples <= 10 else False
-    heatmap = sns.heatmap(distances_mfcc, annot=annot, cmap='YlGnBu', linewidths=0.001, ax=ax)
-    heatmap.set_title('mfcc')
-    heatmap.get_figure().savefig(f"distances_mfcc.png")
-
-    fig, ax = plt.subplots(figsize=(10,10))
-    annot = True if nb_samples <= 10 else False
-    heatmap = sns.heatmap(distances_mel, annot=annot, cmap='YlGnBu', linewidths=0.001, ax=ax)
-    heatmap.set_title('mel')
-    heatmap.get_figure().savefig(f"distances_mel.png")
+    saveHeatmap(distances_mfcc, f"distances_mfcc.png", title='mfcc')
+    saveHeatmap(distances_mel, f"distances_mel.png", title='mel')
 
 def computeFeaturesFromCombinations(combinations, verbose=False):
     start = time.time()
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        futures = [executor.submit(getMeanDescriptors, comb) for comb in combinations]
-        mean_decriptors = [f.result() for f in futures]
-    # reorder
-    mel_list = [m[0] for m in mean_decriptors]
-    mfcc_list = [m[1] for m in mean_decriptors]
+    mel_list, mfcc_list = computeFeaturesFromStfts(combinations, stfts, mel_basis, dct_basis)
     if verbose:
         elapsed = time.time() - start
         estimation = 1000000 * elapsed / len(combinations)
@@ -141,29 +258,161 @@ def computeFeaturesFromCombinations(combinations, verbose=False):
         print(f"Calculing 1000000 should take took {estimation / 3600} hours.")
     return mel_list, mfcc_list
 
-def getAuxDistanceMatrix(indexes, nbcombs):
-    combs = [combinations[idx] for idx in indexes]
-    mfcc = computeFeaturesFromCombinations(combs, verbose=False)[1]
-    mfcc = np.array(mfcc).mean(axis=2)
-    distances = distance_matrix(x=mfcc, y=mfcc)
-    aux_distance = distances + 1e9 * np.eye(nbcombs)
-    return aux_distance
+def initFeatureWorker(stfts_spec, bases):
+    global stfts, stfts_shm, mel_basis, dct_basis
+    stfts_shm, stfts = fromSharedMemory(stfts_spec)
+    mel_basis, dct_basis = bases
+
+def computeMeanMfccsChunk(combs):
+    start = time.time()
+    mfcc = computeFeaturesFromStfts(combs, stfts, mel_basis, dct_basis)[1].mean(axis=2)
+    return mfcc, os.getpid(), time.time() - start
+
+def iterMeanMfccs(combs, workers=DEFAULTWORKERS, chunk_size=DEFAULTSTORECHUNK):
+    """
+    Mean mfccs of an (n, nb flutes) array of sample indexes, yielded in order as (begin, end, mfcc)
+    chunks. With several workers the chunks are computed by a process pool which gets the sample
+    STFTs once through shared memory. The throughput of each worker is printed at the end.
+    """
+    combs = np.asarray(combs, dtype=np.int8)
+    chunks = [(begin, min(begin + chunk_size, len(combs))) for begin in range(0, len(combs), chunk_size)]
+    throughput = {}
+    start = time.time()
+
+    if workers <= 1:
+        results = (computeMeanMfccsChunk(combs[begin:end]) for begin, end in chunks)
+    else:
+        shm, spec = toSharedMemory(stfts)
+        executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers, initializer=initFeatureWorker, initargs=(spec, (mel_basis, dct_basis)))
+        futures = [executor.submit(computeMeanMfccsChunk, combs[begin:end]) for begin, end in chunks]
+        results = (f.result() for f in futures)
+
+    try:
+        for (begin, end), (mfcc, pid, elapsed) in zip(chunks, results):
+            count, busy = throughput.get(pid, (0, 0.))
+            throughput[pid] = (count + end - begin, busy + elapsed)
+            yield begin, end, mfcc
+    finally:
+        if workers > 1:
+            executor.shutdown(wait=True, cancel_futures=True)
+            shm.close()
+            shm.unlink()
+
+    elapsed = time.time() - start
+    print(f"Calculing {len(combs)} audio combinations with {workers} workers took {elapsed} seconds "
+          f"({len(combs) / elapsed:.0f} combinations per second).")
+    for pid, (count, busy) in sorted(throughput.items()):
+        print(f"Worker {pid}: {count} combinations at {count / busy:.0f} combinations per second.")
+
+def getMeanMfccs(indexes):
+    mfcc = computeFeaturesFromCombinations(space.decode(indexes), verbose=False)[1]
+    return mfcc.mean(axis=2)
+
+def saveStoreProgress(progressfile, progress):
+    tmpfile = f"{progressfile}.tmp"
+    with open(tmpfile, 'w') as f:
+        json.dump(progress, f, indent=4)
+    os.replace(tmpfile, progressfile)
+
+def buildFeatureStore(storefile, space, chunk_size=DEFAULTSTORECHUNK, workers=DEFAULTWORKERS):
+    """
+    Write the mean mfcc of every combination to a float32 memmap of shape (nb combinations, n_mfcc).
+    The number of combinations done is saved in a json file next to the store after each chunk,
+    so an interrupted build restarts where it stopped.
+    """
+    progressfile = f"{storefile}.json"
+    nb_combinations = len(space)
+    progress = {
+        'nb_combinations': nb_combinations,
+        'n_mfcc': N_MFCC,
+        'flutes': flutes,
+        'done': 0,
+    }
+    if os.path.exists(storefile) and os.path.exists(progressfile):
+        with open(progressfile, 'r') as f:
+            saved = json.load(f)
+        if {**saved, 'done': 0} == progress:
+            progress = saved
+        else:
+            print(f"Feature store at {storefile} was built from other samples, rebuilding it")
+
+    if progress['done'] == nb_combinations:
+        print(f"Feature store at {storefile} is complete")
+        return
+    print(f"Building feature store at {storefile} from combination {progress['done']}")
+
+    mode = 'r+' if progress['done'] > 0 else 'w+'
+    store = np.memmap(storefile, dtype=np.float32, mode=mode, shape=(nb_combinations, N_MFCC))
+    start = time.time()
+    first = progress['done']
+    combs = space.decode(np.arange(first, nb_combinations))
+    for begin, end, mfcc in iterMeanMfccs(combs, workers, chunk_size):
+        begin, end = first + begin, first + end
+        store[begin:end] = mfcc
+        store.flush()
+        progress['done'] = end
+        saveStoreProgress(progressfile, progress)
+        elapsed = time.time() - start
+        remaining = elapsed * (nb_combinations - end) / (end - first)
+        print(f"Feature store: {end}/{nb_combinations} combinations done, {remaining / 60:.1f} minutes left.")
+    del store
+
+def loadFeatureStore(storefile):
+    """
+    Memory-map a complete feature store, or return None if there is none.
+    """
+    progressfile = f"{storefile}.json"
+    if not (os.path.exists(storefile) and os.path.exists(progressfile)):
+        return None
+    with open(progressfile, 'r') as f:
+        progress = json.load(f)
+    if progress['flutes'] != flutes:
+        print(f"Feature store at {storefile} was built from other samples, ignoring it")
+        return None
+    if progress['done'] < progress['nb_combinations']:
+        print(f"Feature store at {storefile} is incomplete, run with --build-store to finish it")
+        return None
+    shape = (progress['nb_combinations'], progress['n_mfcc'])
+    print(f"Reading features from store at {storefile}")
+    return np.memmap(storefile, dtype=np.float32, mode='r', shape=shape)
 
 if __name__ == "__main__":
 
     ap = ArgumentParser()
     ap.add_argument('--audio_folder', type=str, default=DEFAULTAUDIOFOLDER)
     ap.add_argument('--nbcombs', type=int, default=DEFAULTNBFINALCOMBS)
+    ap.add_argument('--nbflutes', type=int, default=DEFAULTNBFLUTES)
     ap.add_argument('--nbsteps', type=int, default=DEFAULTMAXNBSTEPS)
+    ap.add_argument('--candidates-per-step', type=int, default=DEFAULTCANDIDATESPERSTEP)
     ap.add_argument('--resultsfolder', type=str, default=DEFAULTRESULTSFOLDER)
     ap.add_argument('--seed', type=int, default=DEFAULTSEED)
+    ap.add_argument('--featurestore', type=str, default=None)
+    ap.add_argument('--build-store', action='store_true')
+    ap.add_argument('--workers', type=int, default=DEFAULTWORKERS)
+    ap.add_argument('--restarts', type=int, default=DEFAULTRESTARTS)
+    ap.add_argument('--profile', action='store_true')
+    ap.add_argument('--headless', action='store_true')
+    ap.add_argument('--resume', action='store_true')
 
     args = ap.parse_args()
     audio_folder = args.audio_folder
     nbcombs = args.nbcombs
+    nbflutes = args.nbflutes
     nbsteps = args.nbsteps
+    candidates_per_step = args.candidates_per_step
     resultsfolder = args.resultsfolder
     seed = args.seed
+    featurestore = args.featurestore
+    build_store = args.build_store
+    workers = args.workers
+    restarts = args.restarts
+    profile = args.profile
+    headless = args.headless
+    resume = args.resume
+    profiler = startProfiling() if profile else None
+    if featurestore is None:
+        featurestore = os.path.join(resultsfolder, "mfcc_store.f32")
 
     parameters = vars(args)
     dumped_parameters = json.dumps(parameters, sort_keys=True, indent=4)
@@ -178,7 +427,7 @@ if __name__ == "__main__":
     nb_samples = len(samples)
     print(f"Found {nb_samples} samples at {audio_folder}")
 
-    flutes = {f"flute {k}": [] for k in range(6)}
+    flutes = {f"flute {k}": [] for k in range(nbflutes)}
     for sample in samples:
         label = f"flute {sample[-6]}"
         if label in flutes:
@@ -188,88 +437,71 @@ if __name__ == "__main__":
         print(f"Found {len(flutes[f])} audio samples for {f}")
         flutes[f] = flutes[f]
 
-    combinations = [_ for _ in itertools.product(*['0123456789',]*6)]
-
-    nb_combs = len(combinations)
-    print(f"There are {nb_combs} combinations possible")
+    with span('decode'):
+        bank = loadSampleBank(flutes)
+    with span('sample stfts'):
+        mel_basis, dct_basis = getFeatureBases()
+        stfts = computeSampleStfts(bank, mel_basis.shape[1])
 
+    space = CombinationSpace([len(flutes[f]) for f in flutes])
 
-    print(f"------------------------- STEP -1")
-    indexes = np.random.choice(nb_combs, size=nbcombs, replace=False)
-    aux_distance = getAuxDistanceMatrix(indexes, nbcombs)
-    min_combs_dict = aux_distance.min()
-    print(f"Current indexes are {indexes}")
-    # print(f"Current samples are {[combinations[idx] for idx in indexes]}")
-    print(f"Current min distance is {min_combs_dict}")
+    nb_combs = len(space)
+    print(f"There are {nb_combs} combinations possible")
 
-    eject_a, eject_b = np.unravel_index(aux_distance.argmin(), aux_distance.shape)
-    if aux_distance[eject_a].min() < aux_distance[eject_b].min():
-        eject = int(eject_a)
+    if build_store:
+        os.makedirs(os.path.dirname(os.path.abspath(featurestore)), exist_ok=True)
+        with span('feature store'):
+            buildFeatureStore(featurestore, space, workers=workers)
+    store = loadFeatureStore(featurestore)
+    if restarts > 1 and store is None:
+        ap.error(f"--restarts reads the complete feature store at {featurestore}, build it with --build-store")
+    if store is None:
+        getFeatures = getMeanMfccs
     else:
-        eject = int(eject_b)
-    print(f"Ejecting candidate is located at index {eject}")
-
-    new_cadidate = np.random.choice(nb_combs, size=1, replace=False)
-    print(f"New candidate is {new_cadidate}")
-
-    new_indexes = deepcopy(indexes)
-    new_indexes[eject] = new_cadidate
-    new_aux_distance = getAuxDistanceMatrix(new_indexes, nbcombs)
-    new_min_combs_dict = new_aux_distance.min()
-    print(f"New indexes are {new_indexes}")
-    print(f"New normalized min distance is {new_min_combs_dict}")
-
-    if new_min_combs_dict > min_combs_dict:
-        indexes = new_indexes
-        print(f"Updating indexes to new ones")
-
-    for _ in range(nbsteps):
-        print(f"------------------------- STEP {_}")
-        aux_distance = getAuxDistanceMatrix(indexes, nbcombs)
-        min_combs_dict = aux_distance.min()
-        # print(f"Current indexes are {indexes}")
-        # print(f"Current min distance is {min_combs_dict}")
-
-        eject_a, eject_b = np.unravel_index(aux_distance.argmin(), aux_distance.shape)
-        if aux_distance[eject_a].min() < aux_distance[eject_b].min():
-            eject = int(eject_a)
+        getFeatures = lambda idx: store[idx]
+
+    os.makedirs(resultsfolder, exist_ok=True)
+    checkpointfile = os.path.join(resultsfolder, f"checkpoint_NBFINALCOMBS_{nbcombs}_SEED_{seed}.npz")
+    with span('search'):
+        if restarts > 1:
+            if resume:
+                print(f"Restarts are not checkpointed, running them from the start.")
+            seeds = list(range(seed, seed + restarts))
+            seed, indexes, min_combs_dict, summary = parallelRestarts(
+                np.asarray(store), nbcombs, seeds, nbsteps, candidates_per_step, workers=workers)
+            summaryfile = os.path.join(
+                resultsfolder, f"restarts_NBFINALCOMBS_{nbcombs}_SEEDS_{seeds[0]}_{seeds[-1]}.csv")
+            saveRestartSummary(summary, summaryfile)
+            print(f"Best seed is {seed} with min distance {min_combs_dict}")
         else:
-            eject = int(eject_b)
-        # print(f"Ejecting candidate is located at index {eject}")
-
-        new_cadidate = np.random.choice(nb_combs, size=1, replace=False)
-        # print(f"New candidate is {new_cadidate}")
-
-        new_indexes = deepcopy(indexes)
-        new_indexes[eject] = new_cadidate
-        new_aux_distance = getAuxDistanceMatrix(new_indexes, nbcombs)
-        new_min_combs_dict = new_aux_distance.min()
-        # print(f"New indexes are {new_indexes}")
-        # print(f"New min distance is {new_min_combs_dict}")
-
-        if new_min_combs_dict > min_combs_dict:
-            indexes = new_indexes
-            print(f"Updating indexes to new ones. New min distance is {new_min_combs_dict}")
+            indexes = np.random.choice(nb_combs, size=nbcombs, replace=False)
+            if nbsteps > 0:
+                indexes, min_combs_dict = swapSearch(
+                    getFeatures, nb_combs, indexes, nbsteps,
+                    candidates_per_step=candidates_per_step, verbose=True, checkpoint=checkpointfile, resume=resume)
+            else:
+                min_combs_dict = minDistance(getFeatures(indexes))
+    record('min distance', float(min_combs_dict))
 
     print(f"Final indexes are: {indexes}")
-    final_combinations = [combinations[i] for i in indexes]
-    print(f"Final combinations are: {final_combinations}")
+    final_combinations = space.decode(indexes)
+    print(f"Final combinations are: {final_combinations.tolist()}")
 
     # reorder selected combinations
-    aux_distance = getAuxDistanceMatrix(indexes, nbcombs)
+    aux_distance = auxDistanceMatrix(getFeatures(indexes))
     min_distance = aux_distance.min(axis=0)
     ordered_indexes = np.flip(np.argsort(min_distance))
     print(f"Final ordered indexes are: {ordered_indexes}")
 
-    ordered_final_combinations = [final_combinations[i] for i in ordered_indexes]
-    print(f"Ordered final combinations are: {ordered_final_combinations}")
+    ordered_final_combinations = final_combinations[ordered_indexes]
+    print(f"Ordered final combinations are: {ordered_final_combinations.tolist()}")
 
     # save results
     folder = os.path.join(resultsfolder, f"NBFINALCOMBS_{nbcombs}_SEED_{seed}")
     os.makedirs(folder, exist_ok=True)
     resfile = os.path.join(folder, f"ordered_final_combinations.txt")
     with open(resfile, 'w') as f:
-        f.writelines('\n'.join([','.join(c) for c in ordered_final_combinations])+'\n')
+        f.writelines('\n'.join([','.join(map(str, c)) for c in ordered_final_combinations])+'\n')
     print(f"Final combinations saved at {resfile}")
 
     params = [combinationsToParams(c) for c in ordered_final_combinations]
@@ -278,29 +510,35 @@ if __name__ == "__main__":
         f.writelines('\n'.join(params)+'\n')
     print(f"Final parameters saved at {paramsfile}")
 
-    selected_sound_folder = os.path.join(folder, 'selected_sound')
-    os.makedirs(selected_sound_folder, exist_ok=True)
-    for n, comb in enumerate(ordered_final_combinations):
-        soundfile = os.path.join(selected_sound_folder, f"selected_sound_nb_{n}_combination_{''.join(comb)}.wav")
-        getMeanAudio(comb, savepath=soundfile)
-
-    # show results
-    final_mel, final_mfcc = computeFeaturesFromCombinations(ordered_final_combinations, verbose=False)
-
-    fig, axes = plt.subplots(ncols=nbcombs, sharex=True)
-    for ax, mfccs, comb in zip(axes, final_mfcc, ordered_final_combinations):
-        img = librosa.display.specshow(mfccs, x_axis='time', ax=ax)
-        fig.colorbar(img, ax=[ax])
-        ax.set(title=''.join(comb))
-
-    fig, axes = plt.subplots(figsize=(16,16), ncols=nbcombs, sharex=True)
-    for ax, mel, comb in zip(axes, final_mel, ordered_final_combinations):
-        img = librosa.display.specshow(
-            librosa.power_to_db(mel, ref=np.max),
-            x_axis='time', y_axis='mel', fmax=8000, ax=ax)
-        fig.colorbar(img, ax=[ax])
-        ax.set(title=''.join(comb))
-
-    imgfile = os.path.join(folder, f"ordered_final_combinations.png")
-    fig.savefig(imgfile)
-    os.system(f"open {imgfile}")
+    # mixes and features of the selection are computed once, for the files, the manifest and the plots
+    with span('export'):
+        selected_sound_folder = os.path.join(folder, 'selected_sound')
+        os.makedirs(selected_sound_folder, exist_ok=True)
+        soundfiles = [
+            f"selected_sound_nb_{n}_combination_{''.join(map(str, comb))}.wav"
+            for n, comb in enumerate(ordered_final_combinations)]
+        mixes = getMeanAudios(ordered_final_combinations)
+        saveMeanAudios(mixes, [os.path.join(selected_sound_folder, s) for s in soundfiles])
+        print(f"Selected sounds saved at {selected_sound_folder}")
+
+        final_mel, final_mfcc = computeFeaturesFromCombinations(ordered_final_combinations, verbose=False)
+        selection = [
+            {'rank': n, 'combination': comb.tolist(), 'parameters': params[n], 'file': soundfiles[n],
+             'min_distance': float(min_distance[i]), 'mean_mfcc': final_mfcc[n].mean(axis=1).tolist()}
+            for n, (i, comb) in enumerate(zip(ordered_indexes, ordered_final_combinations))]
+        saveManifest(
+            os.path.join(folder, "selection_manifest.json"), 'soundMfccMaxDistances', parameters, selection,
+            samples={f: flutes[f] for f in flutes}, min_distance=float(min_distance.min()))
+
+    # show results, drawn in the background once the results are saved
+    with span('plots'):
+        imgfile = os.path.join(folder, f"ordered_final_combinations.png")
+        mfccfile = os.path.join(folder, f"ordered_final_combinations_mfcc.png")
+        figures = FigureWorker()
+        figures.submit(
+            saveSpectrograms, final_mel, final_mfcc, [''.join(map(str, c)) for c in ordered_final_combinations],
+            imgfile, mfccfile, fmax=FMAX)
+    saveMetrics(metricsFile(folder, 'soundMfccMaxDistances'), parameters, profiler)
+    figures.close()
+    if not headless:
+        os.system(f"open {imgfile}")
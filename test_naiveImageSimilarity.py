@@ -0,0 +1,53 @@
+"""
+The pairwise matrix engines of naiveImageSimilarity.py against the per-pair functions.
+"""
+
+import itertools
+
+import numpy as np
+
+import naiveImageSimilarity as naive
+from benchmarks import makeFrames
+
+
+def perPairMatrices(images):
+    nb = len(images)
+    l0_distances = np.zeros((nb, nb))
+    emd_distances = np.zeros((nb, nb))
+    for i, j in itertools.combinations(range(nb), 2):
+        l0_distances[i, j] = l0_distances[j, i] = naive.l0(images[i], images[j])
+        emd_distances[i, j] = emd_distances[j, i] = naive.earth_movers_distance(images[i], images[j])
+    return l0_distances, emd_distances
+
+
+def test_pairwise_engines_match_per_pair_functions(tmp_path):
+    images = makeFrames(str(tmp_path), 7, 64, 48)
+    imgs, hists = naive.load_frames(images)
+    l0_distances, emd_distances = perPairMatrices(images)
+
+    np.testing.assert_allclose(naive.pairwise_l0(imgs), l0_distances, rtol=0, atol=1e-9)
+    np.testing.assert_allclose(naive.pairwise_earth_movers_distances(hists), emd_distances, rtol=0, atol=1e-6)
+
+
+def test_pairwise_engines_do_not_depend_on_tiles(tmp_path):
+    images = makeFrames(str(tmp_path), 7, 64, 48)
+    imgs, hists = naive.load_frames(images)
+
+    # tiles of 1 to 3 items, smaller than the number of images
+    np.testing.assert_array_equal(naive.pairwise_l0(imgs, tile_bytes=1), naive.pairwise_l0(imgs))
+    np.testing.assert_array_equal(naive.pairwise_l0(imgs, tile_bytes=64 * 48 * 9), naive.pairwise_l0(imgs))
+    np.testing.assert_array_equal(
+        naive.pairwise_earth_movers_distances(hists, tile_bytes=1), naive.pairwise_earth_movers_distances(hists))
+    np.testing.assert_array_equal(
+        naive.pairwise_earth_movers_distances(hists, tile_bytes=256 * 8 * 9), naive.pairwise_earth_movers_distances(hists))
+
+
+def test_decoding_downsampled_matches_downsampling_the_full_frames(tmp_path):
+    images = makeFrames(str(tmp_path), 5, 64, 48)
+    imgs, hists = naive.load_frames(images)
+    small, small_hists = naive.load_frames(images, downsample=3)
+
+    assert small.shape == (5, 16, 22)
+    np.testing.assert_array_equal(small_hists, hists)
+    np.testing.assert_array_equal(
+        naive.pairwise_l0(small, decoded_downsample=3), naive.pairwise_l0(list(imgs), downsample=3))
@@ -0,0 +1,27 @@
+"""
+The batched features of soundMfccMaxDistances.py against compute_mfcc on the mixed audio.
+"""
+
+import numpy as np
+
+import soundMfccMaxDistances as sound
+
+
+def test_features_from_stfts_match_compute_mfcc():
+    rng = np.random.RandomState(0)
+    t = np.arange(sound.SAMPLINGRATE) / sound.SAMPLINGRATE
+    bank = np.zeros((3, 2, sound.SAMPLINGRATE), dtype=np.float32)
+    for k in range(3):
+        bank[k, 0] = 0.3 * np.sin(2 * np.pi * (200 + 100 * k) * t) + 0.05 * rng.randn(len(t))
+    # near-silent samples, whose mfccs are the largest
+    bank[:, 1] = 1e-6 * rng.randn(3, len(t))
+
+    mel_basis, dct_basis = sound.getFeatureBases()
+    stfts = sound.computeSampleStfts(bank, mel_basis.shape[1])
+    combs = np.array([[0, 0, 0], [1, 1, 1], [0, 1, 0], [1, 0, 1]])
+    mel, mfcc = sound.computeFeaturesFromStfts(combs, stfts, mel_basis, dct_basis)
+
+    for comb, comb_mel, comb_mfcc in zip(combs, mel, mfcc):
+        S, expected = sound.compute_mfcc(bank[np.arange(len(comb)), comb].mean(axis=0), sound.SAMPLINGRATE)
+        np.testing.assert_allclose(comb_mfcc, expected, rtol=0, atol=1e-5 * np.abs(expected).max())
+        np.testing.assert_allclose(comb_mel, S, rtol=0, atol=1e-5 * S.max())
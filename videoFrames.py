@@ -0,0 +1,125 @@
+"""
+Frames of a video read from an ffmpeg rawvideo pipe as numpy arrays, without writing images.
+
+Frames are numbered from 0 in decoding order. Files written for them are named like the
+images of extract_all_frames, %06d.png numbered from 1.
+"""
+
+import os
+import json
+import subprocess
+
+import numpy as np
+
+CHANNELS = {'rgb24': 3, 'bgr24': 3, 'gray': 1}
+
+
+def probeVideo(video_path):
+    """
+    Width, height, frame rate, start time and number of frames of the first video stream, from
+    ffprobe. The number of frames is the number of packets, read without decoding the video.
+    stream_offset is the start of the stream relative to the start of the file, the origin of
+    ffmpeg's input -ss and of the timestamps it decodes without -copyts.
+    """
+    command = [
+        'ffprobe', '-v', 'error',
+        '-select_streams', 'v:0',
+        '-count_packets',
+        '-show_entries', 'stream=width,height,avg_frame_rate,r_frame_rate,start_time,nb_read_packets:format=start_time',
+        '-of', 'json',
+        video_path
+    ]
+    probe = json.loads(subprocess.run(command, check=True, capture_output=True).stdout)
+    stream = probe['streams'][0]
+    start_time = float(stream.get('start_time', 0) or 0)
+    format_start_time = float(probe.get('format', {}).get('start_time', start_time) or 0)
+    rate = stream['avg_frame_rate'] if stream.get('avg_frame_rate', '0/0') != '0/0' else stream['r_frame_rate']
+    num, den = rate.split('/')
+    return {
+        'width': int(stream['width']),
+        'height': int(stream['height']),
+        'fps': float(num) / float(den),
+        'start_time': start_time,
+        'stream_offset': start_time - format_start_time,
+        'nb_frames': int(stream.get('nb_read_packets', 0)),
+    }
+
+def countFrames(video_path):
+    """
+    Exact number of frames of the first video stream, decoded by ffprobe.
+    """
+    command = [
+        'ffprobe', '-v', 'error',
+        '-select_streams', 'v:0',
+        '-count_frames',
+        '-show_entries', 'stream=nb_read_frames',
+        '-of', 'json',
+        video_path
+    ]
+    stream = json.loads(subprocess.run(command, check=True, capture_output=True).stdout)['streams'][0]
+    return int(stream['nb_read_frames'])
+
+def streamFrames(video_path, pix_fmt='rgb24', info=None):
+    """
+    Generator of (index, timestamp in seconds, frame) for every frame of the video, decoded by
+    ffmpeg into a pipe. Frames are (height, width, 3) uint8 arrays, (height, width) for 'gray'.
+    Timestamps are index / fps, the video is read at its constant frame rate.
+    Each frame is a view on a fresh buffer, consumers may keep it.
+    """
+    info = info or probeVideo(video_path)
+    channels = CHANNELS[pix_fmt]
+    shape = (info['height'], info['width'], channels) if channels > 1 else (info['height'], info['width'])
+    frame_bytes = int(np.prod(shape))
+    command = [
+        'ffmpeg', '-v', 'error',
+        '-i', video_path,
+        '-map', '0:v:0',
+        '-f', 'rawvideo',
+        '-pix_fmt', pix_fmt,
+        '-'
+    ]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, bufsize=frame_bytes)
+    try:
+        index = 0
+        while True:
+            buffer = bytearray(frame_bytes)
+            view = memoryview(buffer)
+            read = 0
+            while read < frame_bytes:
+                n = process.stdout.readinto(view[read:])
+                if not n:
+                    break
+                read += n
+            if read < frame_bytes:
+                break
+            yield index, index / info['fps'], np.frombuffer(buffer, dtype=np.uint8).reshape(shape)
+            index += 1
+    finally:
+        process.stdout.close()
+        if process.poll() is None:
+            process.kill()
+        process.wait()
+
+def frameName(index):
+    return f"{index + 1:06d}"
+
+def saveFrames(video_path, indexes, folder, names=None):
+    """
+    Write the frames at indexes as png files in folder, named after the frame number unless
+    names are given. Decoding stops after the last of them. Returns the written paths by index.
+    """
+    from PIL import Image
+
+    os.makedirs(folder, exist_ok=True)
+    indexes = [int(i) for i in indexes]
+    names = names or [f"{frameName(i)}.png" for i in indexes]
+    wanted = dict(zip(indexes, names))
+    last = max(indexes, default=-1)
+    paths = {}
+    for index, _, frame in streamFrames(video_path):
+        if index in wanted:
+            paths[index] = os.path.join(folder, wanted[index])
+            Image.fromarray(frame).save(paths[index])
+        if index >= last:
+            break
+    return paths